@@ -1,15 +1,41 @@
 from __future__ import unicode_literals, print_function
 
 import os
+import io
+import re
 import sys
+import copy
+import bisect
+import random
+import time
+import atexit
 import logging
+import warnings
 import json
+import hashlib
+import keyword
+import struct
+import base64
+import binascii
+import zlib
+import importlib
+import threading
 from decimal import Decimal, InvalidOperation
 try:
     import urllib.parse as urlparse
 except ImportError:
     import urlparse
 
+try:
+    from collections.abc import Mapping, MutableMapping
+except ImportError:
+    from collections import Mapping, MutableMapping
+
+try:
+    import contextvars
+except ImportError:
+    contextvars = None
+
 try:
     from django.core.exceptions import ImproperlyConfigured
 except ImportError:
@@ -22,7 +48,7 @@ except ImportError:
         pass
 
 try:
-    from django.utils.six import string_types
+    from django.utils.six import string_types, text_type
 except ImportError:
     if sys.version_info[0] == 3:
         string_types = (str,)
@@ -31,6 +57,9 @@ except ImportError:
         string_types = (basestring,)
         text_type = unicode
 
+if sys.version_info[0] == 3:
+    long = int
+
 
 __version__ = '0.1.1'
 
@@ -41,6 +70,31 @@ NOTSET = type(str('NoValue'), (object,), {})
 logger = logging.getLogger(__name__)
 
 
+# Use the highest resolution clock available for timing lookups
+_clock = getattr(time, 'perf_counter', time.time)
+
+# References to other variables in interpolated values, and escaped dollars
+_reference = re.compile(r'\$(?:\$|\{([A-Za-z_][A-Za-z0-9_]*)\})')
+
+# The start of every item in a list or dict which is not empty
+_item = re.compile(r'(?:^|,)\s*(?=[^\s,])', re.UNICODE)
+
+# Cast defaults, keyed by the id of the default and the cast. See
+# Environment._cast_default.
+_cast_defaults = {}
+_cast_defaults_size = 1024
+
+# Casts of compressed values, keyed by the hash of the value and the cast.
+# See Compressed.
+_decompressed = {}
+_decompressed_size = 1024
+
+# Callables notified of every lookup. Kept empty unless something like
+# `profile` is active, so that `Environment._get` can skip all bookkeeping
+# with a single truth test.
+_observers = []
+
+
 class Environment(object):
     """Class for reading and casting environment variables
 
@@ -50,15 +104,46 @@ class Environment(object):
 
     Args:
         environ (`dict`): Environment to read variables from
+        interpolate (`bool`): Whether to expand references to other
+            variables, written as ``${VAR}``, in values. ``$$`` is expanded
+            to a literal ``$``. See interpolation.
+        environb (`dict`): Environment with `bytes` keys and values, read by
+            `bytes`, `base64` and `hex`. Defaults to `os.environb` if environ
+            is `os.environ`, and otherwise values are encoded from environ.
     """
 
     _collections = (dict, list, set, tuple)
     _lists = (list, set, tuple)
-
-    def __init__(self, environ):
+    _scalars = (bool, int, float, Decimal, text_type, str)
+
+    # Casts which are always done right away by resolve_many, and the length
+    # from which collections are cast on the executor
+    _cheap_casts = (None, bool, int, float, Decimal, text_type, str,
+                    urlparse.urlparse)
+    _expensive_size = 4096
+
+    #: Largest length of a value read from the environ, or `None` for no
+    #: limit. Longer values raise `ImproperlyConfigured` before being cast.
+    max_size = None
+
+    #: Largest number of items in a value cast to a collection, or `None`
+    #: for no limit. Checked before the value is split, and empty items are
+    #: not counted.
+    max_items = None
+
+    def __init__(self, environ, interpolate=False, environb=None):
+        if environb is None and environ is os.environ:
+            environb = getattr(os, 'environb', None)
         self.environ = environ
-
-    def __call__(self, var, default=NOTSET, cast=None, force=True):
+        self.environb = environb
+        self.interpolate = interpolate
+        self._reloads = 0
+        self._expanded = {}
+        self._expanded_version = None
+        self._snapshot = None
+
+    def __call__(self, var, default=NOTSET, cast=None, force=True,
+                 encoding=None):
         """Function interface
 
         Once the environment has been initialised, it can be called as a
@@ -81,10 +166,13 @@ class Environment(object):
         Args:
             var (`str`): The name of the environment variable
             default: The value to return if the environment variable does not
-                exist
+                exist. Its cast is cached, so a default which is not a `dict`,
+                `list`, `set` or `tuple` must not be changed in place
             cast: type or function for casting environment variable. See
                 casting
             force (`bool`): Whether to force casting of the default value
+            encoding (`str`): How the value was compressed and encoded, such
+                as ``'zlib+base64'``. See `Compressed`.
 
         Returns:
             The environment variable if it exists, otherwise default
@@ -92,6 +180,8 @@ class Environment(object):
         Raises:
             ImproperlyConfigured
         """
+        if encoding is not None:
+            cast = Compressed(cast, encoding)
         return self._get(var, default=default, cast=cast, force=force)
 
     def __contains__(self, var):
@@ -107,8 +197,46 @@ class Environment(object):
             >>> 'ANOTHER_VAR' in env
             False
         """
+        if _override_depth:
+            layer = _override_layer(self)
+            if layer and var in layer:
+                return layer[var] is not None
         return var in self.environ
 
+    @property
+    def version(self):
+        """Version of the environ, if it keeps one
+
+        Increases whenever the environ is changed, if it is a
+        `VersionedEnviron` or another mapping with a ``version`` attribute.
+        Caches built on the environment can compare it to the version they
+        were built from, instead of comparing raw values.
+
+        The version also increases on every `reload`.
+
+        Returns:
+            `int`, or `None` if the environ does not keep a version
+        """
+        version = getattr(self.environ, 'version', None)
+        if version is None:
+            return None
+        return version + self._reloads
+
+    def reload(self):
+        """Drop everything cached from the environ
+
+        Only needed after changing the environ without going through the
+        `VersionedEnviron` it is wrapped in, since other changes are detected
+        automatically.
+        """
+        start = _clock()
+        self._reloads += 1
+        self._expanded = {}
+        self._expanded_version = None
+        self._snapshot = None
+        if _observers:
+            _notify('reloaded', self, _clock() - start)
+
     # Simple builtins
 
     def bool(self, var, default=NOTSET, force=True):
@@ -129,37 +257,41 @@ class Environment(object):
 
     # Builtin collections
 
-    def tuple(self, var, default=NOTSET, cast=None, force=True):
+    def tuple(self, var, default=NOTSET, cast=None, force=True,
+              encoding=None):
         """Convenience method for casting to a tuple
 
         Note:
             Casting
         """
-        return self._get(var, default=default, cast=(cast,), force=force)
+        return self(var, default, (cast,), force, encoding)
 
-    def list(self, var, default=NOTSET, cast=None, force=True):
+    def list(self, var, default=NOTSET, cast=None, force=True,
+             encoding=None):
         """Convenience method for casting to a list
 
         Note:
             Casting
         """
-        return self._get(var, default=default, cast=[cast], force=force)
+        return self(var, default, [cast], force, encoding)
 
-    def set(self, var, default=NOTSET, cast=None, force=True):
+    def set(self, var, default=NOTSET, cast=None, force=True,
+            encoding=None):
         """Convenience method for casting to a set
 
         Note:
             Casting
         """
-        return self._get(var, default=default, cast={cast}, force=force)
+        return self(var, default, {cast}, force, encoding)
 
-    def dict(self, var, default=NOTSET, cast=None, force=True):
+    def dict(self, var, default=NOTSET, cast=None, force=True,
+             encoding=None):
         """Convenience method for casting to a dict
 
         Note:
             Casting
         """
-        return self._get(var, default=default, cast={str: cast}, force=force)
+        return self(var, default, {str: cast}, force, encoding)
 
     # Other types
 
@@ -171,37 +303,667 @@ class Environment(object):
         """
         return self._get(var, default=default, cast=Decimal, force=force)
 
-    def json(self, var, default=NOTSET, force=True):
+    def json(self, var, default=NOTSET, force=True, encoding=None):
         """Get environment variable, parsed as a json string"""
-        return self._get(var, default=default, cast=json.loads, force=force)
+        return self(var, default, json.loads, force, encoding)
 
     def url(self, var, default=NOTSET, force=True):
         """Get environment variable, parsed with urlparse/urllib.parse"""
         return self._get(var, default=default, cast=urlparse.urlparse,
                          force=force)
 
+    # Binary data
+
+    def bytes(self, var, default=NOTSET, force=True, view=False):
+        """Get environment variable as bytes
+
+        Read from `environb` without decoding, when available.
+
+        Args:
+            view (`bool`): Return a `memoryview` of the value instead
+        """
+        value = self._get(var, default=default, cast=to_bytes, force=force,
+                          binary=True)
+        return _view(value, view)
+
+    def base64(self, var, default=NOTSET, force=True, urlsafe=False,
+               view=False):
+        """Get environment variable, decoded from base64
+
+        Args:
+            urlsafe (`bool`): Decode the URL and filename safe alphabet, with
+                ``-`` and ``_`` instead of ``+`` and ``/``
+            view (`bool`): Return a `memoryview` of the value instead
+        """
+        cast = from_base64url if urlsafe else from_base64
+        value = self._get(var, default=default, cast=cast, force=force,
+                          binary=True)
+        return _view(value, view)
+
+    def hex(self, var, default=NOTSET, force=True, view=False):
+        """Get environment variable, decoded from hexadecimal
+
+        Args:
+            view (`bool`): Return a `memoryview` of the value instead
+        """
+        value = self._get(var, default=default, cast=from_hex, force=force,
+                          binary=True)
+        return _view(value, view)
+
+    # Schemas
+
+    def resolve(self, schema):
+        """Read every variable in a schema
+
+        A schema maps variable names to either a cast, or a `dict` of keyword
+        arguments for `__call__`. It can also be given as a sequence of
+        ``(var, spec)`` pairs.
+
+        Examples:
+            >>> env = Environment({'PORT': '80'})
+            >>> env.resolve({'PORT': int, 'DEBUG': {'cast': bool,
+            ...                                     'default': False}})
+            {'PORT': 80, 'DEBUG': False}
+
+        Args:
+            schema: The variables to read
+
+        Returns:
+            `dict` mapping variable names to values
+
+        Raises:
+            ImproperlyConfigured: Listing every variable which could not
+                be read
+        """
+        return self.resolve_many(schema)
+
+    def resolve_many(self, schema, executor=None):
+        """Read every variable in a schema, casting slow values in parallel
+
+        Values with expensive casts are cast on the executor, while cheap
+        casts are done right away. Expensive casts are `json.loads`, custom
+        callables, and collections with long values. When using a process
+        pool, custom casts must be picklable.
+
+        Values in a loaded snapshot are not cast again. Observers, such as
+        `profile`, see casts done on the executor as lookups lasting from
+        submitting the cast until its result is used.
+
+        Errors from all variables are collected, and raised together.
+
+        Examples:
+            >>> with ThreadPoolExecutor() as executor:
+            ...     values = env.resolve_many(SCHEMA, executor=executor)
+
+        Args:
+            schema: The variables to read, see `resolve`
+            executor: A `concurrent.futures.Executor`, or `None` to cast
+                every value right away
+
+        Returns:
+            `dict` mapping variable names to values
+
+        Raises:
+            ImproperlyConfigured: Listing every variable which could not
+                be read
+        """
+        values = {}
+        errors = []
+        futures = []
+        for var, kwargs in _normalize_schema(schema):
+            cast = kwargs.get('cast')
+            default = kwargs.get('default', NOTSET)
+            try:
+                if executor is None or var not in self:
+                    values[var] = self._get(var, **kwargs)
+                    continue
+                value = self._raw(var)
+                if self.max_size is not None:
+                    self._check_size(var, value)
+                # Everything but expensive casts goes through the usual
+                # lookup, so that snapshots and observers apply
+                if (((kwargs.get('force', True) and default is not None) or
+                        value != default) and
+                        self._is_expensive(value, cast) and
+                        not (self._snapshot and var in self._snapshot)):
+                    futures.append((var, kwargs, _clock(), executor.submit(
+                        _cast_value, var, value, cast, self.max_items)))
+                else:
+                    values[var] = self._get(var, **kwargs)
+            except ImproperlyConfigured as e:
+                errors.append(str(e))
+
+        for var, kwargs, start, future in futures:
+            error = None
+            try:
+                values[var] = future.result()
+            except ImproperlyConfigured as e:
+                error = e
+                errors.append(str(e))
+            if _observers:
+                # Timed from submitting the cast until its result is used
+                observers = [observer for observer in _observers
+                             if observer.wants_lookup()]
+                self._record(observers, var, kwargs.get('default', NOTSET),
+                             kwargs.get('cast'), 'environ', start, error,
+                             kwargs.get('force', True))
+
+        if len(errors) == 1:
+            raise ImproperlyConfigured(errors[0])
+        if errors:
+            msg = "{} environment variables are not configured correctly:\n"
+            raise ImproperlyConfigured(msg.format(len(errors)) + '\n'.join(
+                '  - ' + error for error in errors))
+        return values
+
+    def compile_module(self, schema, path):
+        """Write the values of a schema to a Python module
+
+        The module contains one constant per variable, and ``ENVY_HASH``, a
+        hash of the schema and the raw environment values it was generated
+        from. Load it with `load_compiled`.
+
+        Args:
+            schema: The variables to read, see `resolve`
+            path (`str`): File name of the module to write
+
+        Raises:
+            ImproperlyConfigured: If a variable is missing, or its value
+                cannot be written as a Python literal
+        """
+        entries = _normalize_schema(schema)
+        values = self.resolve(entries)
+        lines = [
+            '# Generated by django-envy {}. Do not edit.'.format(__version__),
+            'from __future__ import unicode_literals',
+            'from decimal import Decimal',
+            'from {} import ParseResult'.format(urlparse.__name__),
+            '',
+            'ENVY_HASH = {!r}'.format(str(self._schema_hash(entries))),
+            '',
+        ]
+        for var, _ in entries:
+            if not _is_identifier(var):
+                msg = ("Environment variable '{}' cannot be compiled: "
+                       "it is not a valid Python identifier")
+                raise ImproperlyConfigured(msg.format(var))
+            lines.append('{} = {}'.format(var, _literal(var, values[var])))
+
+        with open(path, 'w') as fp:
+            fp.write('\n'.join(lines) + '\n')
+
+    def load_compiled(self, schema, module):
+        """Read a schema from a module written by `compile_module`
+
+        The compiled values are only used if the module exists and was
+        generated from the current schema and environment. Otherwise the
+        schema is resolved from the environment as usual.
+
+        Args:
+            schema: The variables to read, see `resolve`
+            module (`str`): Dotted name of the compiled module
+
+        Returns:
+            `dict` mapping variable names to values
+        """
+        entries = _normalize_schema(schema)
+        try:
+            compiled = importlib.import_module(module)
+        except ImportError:
+            compiled = None
+
+        hit = (compiled is not None and
+               getattr(compiled, 'ENVY_HASH', None) ==
+               self._schema_hash(entries))
+        if _observers:
+            _notify('cache', 'compiled', hit)
+        if hit:
+            return {var: getattr(compiled, var) for var, _ in entries}
+        return self.resolve(entries)
+
+    def snapshot(self, schema):
+        """Capture the values of a schema, for use in other processes
+
+        The returned `Snapshot` pickles compactly, and can be loaded in a
+        child process with `load_snapshot` or `init_worker`, so that the
+        child does not cast the same values again.
+
+        Args:
+            schema: The variables to capture, see `resolve`. Variables which
+                are not set are left out, as are variables with casts which
+                cannot be told apart by name, such as lambdas.
+
+        Returns:
+            `Snapshot`
+        """
+        values = {}
+        for var, kwargs in _normalize_schema(schema):
+            if var in self and _is_stable(kwargs.get('cast')):
+                values[var] = (_cast_name(kwargs.get('cast')),
+                               self._get(var, **kwargs))
+        return Snapshot(self._raw_hash(sorted(values)), values)
+
+    def load_snapshot(self, snapshot):
+        """Use the values from a `Snapshot` instead of casting them again
+
+        The snapshot is only used if the raw values of its variables match
+        the environ. Afterwards, each snapshot value is used when the variable
+        is read with the same cast, and its raw value is unchanged.
+
+        Args:
+            snapshot (`Snapshot`): Values captured with `snapshot`
+
+        Returns:
+            `bool`, whether the snapshot was loaded
+        """
+        variables = sorted(snapshot.values)
+        try:
+            if self._raw_hash(variables) != snapshot.digest:
+                return False
+        except KeyError:
+            # A variable is not set here
+            return False
+        self._snapshot = {
+            var: (self._raw(var),) + snapshot.values[var]
+            for var in variables
+        }
+        return True
+
+    def fingerprint(self, schema):
+        """Stable hash of the values of a schema
+
+        The hash is computed from the cast values, not the raw strings, so
+        environments which configure the same values hash the same, across
+        processes and hosts. Use it to version cache keys, or to detect
+        configuration drift between nodes.
+
+        Examples:
+            >>> env = Environment({'PORT': '1_000'})
+            >>> env.fingerprint({'PORT': int}).hexdigest() == \\
+            ...     Environment({'PORT': '1000'}).fingerprint(
+            ...         {'PORT': int}).hexdigest()
+            True
+
+        Args:
+            schema: The variables to hash, see `resolve`. A list of names
+                hashes the raw values.
+
+        Returns:
+            `Fingerprint`
+        """
+        return Fingerprint(self, schema)
+
+    def share(self, schema, name, size=None):
+        """Publish the values of a schema to shared memory
+
+        Creates the shared memory segment `name`, or publishes a new version
+        to it if it already exists. See `SharedConfig`.
+
+        Args:
+            schema: The variables to read, see `resolve`
+            name (`str`): Name of the shared memory segment
+            size (`int`): Capacity of the segment in bytes, when creating it
+
+        Returns:
+            `SharedConfig`
+        """
+        _require_shared_memory()
+        values = self.resolve(schema)
+        try:
+            return SharedConfig.create(name, values, size=size)
+        except FileExistsError:
+            # The segment exists, most likely from an earlier publish
+            config = SharedConfig.attach(name)
+            config.publish(values)
+            return config
+
+    def override(self, *args, **values):
+        """Temporarily override environment variables
+
+        Returns a context manager, which layers the given values on top of the
+        environ without changing it. Overrides are stored in a
+        `contextvars.ContextVar`, so they only apply to the current thread or
+        asyncio task, and nested overrides are layered on top of each other.
+        Set a variable to `None` to make it appear unset.
+
+        Lookups cost nothing extra while no overrides are active anywhere.
+
+        Examples:
+            >>> env = Environment({'FOO': '0', 'BAR': '1'})
+            >>> with env.override(FOO='1', BAR=None):
+            ...     env('FOO'), 'BAR' in env
+            ('1', False)
+            >>> env('FOO')
+            '0'
+
+        Args:
+            Values as a `dict` and/or keyword arguments
+
+        Returns:
+            `Override`
+        """
+        return Override(self, dict(*args, **values))
+
+    def accessor(self, var, default=NOTSET, cast=None, force=True):
+        """Bind a lookup to a callable, which caches the value
+
+        Calling the returned `Accessor` returns the value, which is only read
+        and cast again when the environment has changed. With a versioned
+        environ, this is a single version comparison, and otherwise a
+        comparison of the raw value. Meant for values read on hot paths, such
+        as feature flags in middleware.
+
+        Examples:
+            >>> FEATURE_X = env.accessor('FEATURE_X', cast=bool, default=False)
+            >>> if FEATURE_X():
+            ...     pass
+
+        Args:
+            See `__call__`
+
+        Returns:
+            `Accessor`
+
+        Raises:
+            ImproperlyConfigured: When called, if the variable is missing or
+                cannot be cast
+        """
+        return Accessor(self, var, default, cast, force)
+
+    def derived(self, schema):
+        """Decorator for values computed from environment variables
+
+        The decorated function is called with the values of the variables in
+        the schema, in order, and replaced by a `Derived`. Calling it returns
+        the computed value, which is only computed again when one of the
+        variables has changed.
+
+        Examples:
+            >>> @env.derived([('WEB_CONCURRENCY', int),
+            ...               ('DB_MAX_CONN', {'cast': int, 'default': 100})])
+            ... def DB_POOL_SIZE(concurrency, max_conn):
+            ...     return max_conn // concurrency
+            >>> DB_POOL_SIZE()
+            25
+
+        Args:
+            schema: The variables the value is computed from, see `resolve`.
+                Use a sequence of pairs to guarantee the order on Python 2.
+
+        Returns:
+            A decorator returning a `Derived`
+        """
+        def decorator(func):
+            return Derived(self, func, schema)
+        return decorator
+
+    def overlay(self, *args, **values):
+        """Environment overriding a few variables of this one
+
+        The overlay only stores the values it overrides, and reads every
+        other variable through this environment, sharing its caches. Meant
+        for creating many environments which differ in a few variables,
+        such as one per tenant. Unlike `override`, the values apply
+        everywhere the overlay is used.
+
+        Examples:
+            >>> env = Environment({'DB_HOST': 'db', 'DB_NAME': 'main'})
+            >>> tenant = env.overlay(DB_NAME='tenant_1')
+            >>> tenant('DB_HOST'), tenant('DB_NAME')
+            ('db', 'tenant_1')
+
+        Args:
+            Values as a `dict` and/or keyword arguments, with `None` for
+            unset variables
+
+        Returns:
+            `Overlay`
+        """
+        return Overlay(self, dict(*args, **values))
+
     # Private API
 
-    def _get(self, var, default=NOTSET, cast=None, force=True):
-        # Find the value in the environ
+    def _schema_hash(self, entries):
+        # Hash of a normalized schema and the raw values it reads
+        digest = hashlib.sha256(__version__.encode('utf-8'))
+        for var, kwargs in sorted(entries, key=lambda entry: entry[0]):
+            default = kwargs.get('default', NOTSET)
+            try:
+                raw = self._raw(var)
+            except KeyError:
+                raw = None
+            parts = [
+                var,
+                '' if raw is None else repr(raw),
+                _cast_name(kwargs.get('cast')),
+                '' if default is NOTSET else repr(default),
+                repr(kwargs.get('force', True)),
+            ]
+            digest.update('\0'.join(parts).encode('utf-8') + b'\1')
+        return digest.hexdigest()
+
+    def _is_expensive(self, value, cast):
+        # Whether casting a value is worth handing off to an executor
+        if cast in self._cheap_casts:
+            return False
+        if cast is json.loads or isinstance(cast, Compressed):
+            return True
+        if cast in self._collections or isinstance(cast, self._collections):
+            return (isinstance(value, string_types) and
+                    len(value) >= self._expensive_size)
+        return callable(cast)
+
+    def _raw_hash(self, variables):
+        # Hash of the raw values of variables, which must all be set
+        digest = hashlib.sha256()
+        for var in variables:
+            digest.update(repr((var, self._raw(var))).encode('utf-8'))
+        return digest.hexdigest()
+
+    def _get(self, var, default=NOTSET, cast=None, force=True, binary=False):
+        if _observers:
+            return self._get_observed(var, default, cast, force, binary)
+        return self._resolve(var, default, cast, force, binary)
+
+    def _get_observed(self, var, default, cast, force, binary=False):
+        # Only lookups some observer wants are timed and recorded
+        observers = [observer for observer in _observers
+                     if observer.wants_lookup()]
+        if not observers:
+            return self._resolve(var, default, cast, force, binary)
+
+        if var in self:
+            source = 'environ'
+        elif default is not NOTSET:
+            source = 'default'
+        else:
+            source = 'missing'
+
+        error = None
+        start = _clock()
+        try:
+            return self._resolve(var, default, cast, force, binary)
+        except ImproperlyConfigured as e:
+            error = e
+            raise
+        finally:
+            self._record(observers, var, default, cast, source, start, error,
+                         force)
+
+    def _record(self, observers, var, default, cast, source, start, error,
+                force):
+        lookup = Lookup(self, var, default, cast, source, start,
+                        _clock() - start, error, force)
+        for observer in observers:
+            observer(lookup)
+
+    def _resolve(self, var, default, cast, force, binary=False):
+        # Find the value in the environ, as bytes for binary casts
         # If the value is missing, use the default or raise an error
         try:
-            value = self.environ[var]
+            value = self._raw_bytes(var) if binary else self._raw(var)
         except KeyError:
             if default is NOTSET:
                 msg = "Set the environment variable '{}'".format(var)
                 raise ImproperlyConfigured(msg)
-            else:
-                value = default
+            # The default is only cast if we force, and it is not None.
+            # Scalar casts are cheaper than a cache lookup, and a default
+            # which already has the type of the cast is returned as it is.
+            if not force or default is None or cast is None:
+                return default
+            if cast in self._scalars:
+                if type(default) is cast:
+                    return default
+                return self._cast(var, default, cast)
+            return self._cast_default(var, default, cast)
+
+        if self.max_size is not None:
+            self._check_size(var, value)
+
+        # Use the value from a loaded snapshot, if it was cast the same way
+        # from the same raw value
+        if self._snapshot is not None and var in self._snapshot:
+            raw, name, cast_value = self._snapshot[var]
+            hit = (raw == value and name == _cast_name(cast) and
+                   _is_stable(cast))
+            if _observers:
+                _notify('cache', 'snapshot', hit)
+            if hit:
+                return _copy_mutable(cast_value)
 
         # Cast value if:
-        #  1. it is different than the default
-        #  2. we force, and default different from None
-        if (value != default) or (force and default is not None):
+        #  1. we force, and default different from None
+        #  2. it is different than the default
+        # Checked in this order, to avoid comparing against large defaults
+        if ((force and default is not None) or
+                (value is not default and value != default)):
             value = self._cast(var, value, cast)
 
         return value
 
+    def _check_size(self, var, value):
+        if (isinstance(value, (text_type, bytes)) and
+                len(value) > self.max_size):
+            msg = ("Environment variable '{}' is too long: {} characters, "
+                   "the limit is {}")
+            raise ImproperlyConfigured(
+                msg.format(var, len(value), self.max_size))
+
+    def _check_items(self, var, value):
+        # Empty items are skipped like the casts skip them, but counted
+        # without splitting, stopping at the first item over the limit
+        for count, _ in enumerate(_item.finditer(value), 1):
+            if count > self.max_items:
+                msg = ("Environment variable '{}' has too many items, the "
+                       "limit is {}")
+                raise ImproperlyConfigured(msg.format(var, self.max_items))
+
+    def _cast_default(self, var, default, cast):
+        # Cast a default once per default object and cast. The default
+        # is kept in the cache, so that its id is not reused while cached.
+        # Collections are kept as a copy, and cast again when the default was
+        # changed in place; other defaults must not be changed in place.
+        if isinstance(cast, Compressed):
+            # Defaults are not compressed
+            cast = cast.cast
+        try:
+            key = (id(default), _cast_key(cast))
+            cached = _cast_defaults.get(key)
+        except TypeError:
+            # Unhashable custom cast
+            return self._cast(var, default, cast)
+
+        hit = (cached is not None and cached[0] is default and
+               (cached[1] is default or cached[1] == default))
+        if _observers:
+            _notify('cache', 'defaults', hit)
+        if hit:
+            value = cached[2]
+        else:
+            value = self._cast(var, default, cast)
+            if len(_cast_defaults) >= _cast_defaults_size:
+                _cast_defaults.clear()
+            copied = default
+            if (isinstance(default, self._collections) and
+                    not _is_immutable(default)):
+                copied = copy.deepcopy(default)
+            _cast_defaults[key] = (default, copied, value)
+        return _copy_mutable(value)
+
+    def _raw(self, var):
+        # The value of a variable before casting. Raises KeyError if unset.
+        layer = _override_layer(self) if _override_depth else None
+        if self.interpolate:
+            if layer:
+                return self._expand(var, (), {}, layer)
+            return self._expand(var, ())
+        return _layered(self.environ, layer, var)
+
+    def _raw_bytes(self, var):
+        # The value of a variable as bytes, read straight from environb when
+        # neither overrides nor interpolation apply. Raises KeyError if unset.
+        if (self.environb is None or self.interpolate or
+                (_override_depth and _override_layer(self))):
+            return _encode_raw(var, self._raw(var))
+        return self.environb[_encode_raw(var, var)]
+
+    def _expand(self, var, stack, memo=None, layer=None):
+        # Expand references in a value, memoizing the result along with the
+        # raw values of every variable it was expanded from. The memo is
+        # dropped when a versioned environ changes, and otherwise validated
+        # against those raw values. Values expanded while overrides are
+        # active use a throwaway memo instead.
+        if memo is None:
+            version = self.version
+            if version is None:
+                cached = self._expanded.get(var)
+                if cached is not None and all(
+                        self.environ.get(dep, NOTSET) == raw
+                        for dep, raw in cached[1].items()):
+                    return cached[0]
+            elif version != self._expanded_version:
+                self._expanded = {}
+                self._expanded_version = version
+            elif var in self._expanded:
+                return self._expanded[var][0]
+            memo = self._expanded
+        elif var in memo:
+            return memo[var][0]
+
+        raw = _layered(self.environ, layer, var)
+        deps = {var: raw}
+        if isinstance(raw, string_types) and '$' in raw:
+            stack = stack + (var,)
+            nested = memo if layer else None
+
+            def replace(match):
+                name = match.group(1)
+                if name is None:
+                    return '$'
+                if name in stack:
+                    cycle = ' -> '.join(stack[stack.index(name):] + (name,))
+                    msg = ("Environment variable '{}' could not be "
+                           "interpolated: circular reference {}")
+                    raise ImproperlyConfigured(msg.format(var, cycle))
+                try:
+                    value = self._expand(name, stack, nested, layer)
+                except KeyError:
+                    msg = ("Environment variable '{}' could not be "
+                           "interpolated: '{}' is not set")
+                    raise ImproperlyConfigured(msg.format(var, name))
+                deps.update(memo[name][1])
+                return value
+
+            value = _reference.sub(replace, raw)
+        else:
+            value = raw
+
+        if self.max_size is not None:
+            # Nested references can expand exponentially
+            self._check_size(var, value)
+        memo[var] = (value, deps)
+        return value
+
     def _cast(self, var, value, cast):
         if cast is None:
             pass
@@ -251,8 +1013,12 @@ class Environment(object):
             if isinstance(value, self._lists):
                 value = cast(value)
             elif isinstance(value, string_types):
-                parts = value.split(',')
-                value = cast([p.strip() for p in parts if p.strip()])
+                if self.max_items is not None:
+                    self._check_items(var, value)
+                # Linear in the length of the value: split builds the one
+                # list of parts, and each part is stripped once
+                parts = (p.strip() for p in value.split(','))
+                value = cast([p for p in parts if p])
             else:
                 msg = "Cannot cast environment variable '{}' from {} to {}"
                 formatted = msg.format(var, type(value), type(cast))
@@ -278,9 +1044,19 @@ class Environment(object):
             if isinstance(value, dict):
                 pass
             elif isinstance(value, string_types):
-                parts = [i.strip() for i in value.split(',') if i.strip()]
-                items = [p.split('=', 1) for p in parts]
-                value = {k.strip(): v.strip() for k, v in items}
+                if self.max_items is not None:
+                    self._check_items(var, value)
+                # Linear like lists, with one partition per part
+                items = {}
+                for index, part in enumerate(value.split(',')):
+                    key, sep, item = part.partition('=')
+                    if sep:
+                        items[key.strip()] = item.strip()
+                    elif key.strip():
+                        msg = ("Environment variable '{}' could not be "
+                               "parsed as dict: item {} is not 'key=value'")
+                        raise ImproperlyConfigured(msg.format(var, index + 1))
+                value = items
             else:
                 msg = "Cannot cast environment variable '{}' from {} to {}"
                 formatted = msg.format(var, type(value), type(cast))
@@ -305,6 +1081,9 @@ class Environment(object):
             value = {self._cast(var, k, keycast): self._cast(var, v, valcast)
                      for k, v in parts.items()}
 
+        elif isinstance(cast, Compressed):
+            value = cast.cast_value(self, var, value)
+
         else:
             try:
                 value = cast(value)
@@ -316,6 +1095,2324 @@ class Environment(object):
         return value
 
 
-# Export an initialized environment for convenience
+class VersionedEnviron(MutableMapping):
+    """Environ wrapper counting the changes made through it
 
-env = Environment(os.environ)
+    `os.environ` gives no signal when it changes. This wrapper increments
+    `version` on every change made through it, so that caches can check
+    whether they are stale with a single integer comparison. Changes made to
+    the wrapped mapping directly are not counted, so all code changing the
+    environment must go through the wrapper.
+
+    Examples:
+        >>> environ = VersionedEnviron()
+        >>> env = Environment(environ)
+        >>> environ['DEBUG'] = 'true'
+        >>> env.version
+        1
+
+    Args:
+        environ (`dict`): Mapping to wrap, defaults to `os.environ`
+
+    Attributes:
+        version (`int`): Number of changes made through the wrapper
+    """
+
+    def __init__(self, environ=None):
+        self.environ = os.environ if environ is None else environ
+        self.version = 0
+
+    def __getitem__(self, key):
+        return self.environ[key]
+
+    def __setitem__(self, key, value):
+        self.environ[key] = value
+        self.version += 1
+
+    def __delitem__(self, key):
+        del self.environ[key]
+        self.version += 1
+
+    def __contains__(self, key):
+        return key in self.environ
+
+    def __iter__(self):
+        return iter(self.environ)
+
+    def __len__(self):
+        return len(self.environ)
+
+    def __repr__(self):
+        return '{}({!r})'.format(type(self).__name__, self.environ)
+
+    def get(self, key, default=None):
+        return self.environ.get(key, default)
+
+    def update(self, *args, **kwargs):
+        """Update several variables, as a single change"""
+        self.environ.update(*args, **kwargs)
+        self.version += 1
+
+    def putenv(self, key, value):
+        """Set a variable, like `os.putenv`
+
+        Unlike `os.putenv`, the change is also visible through the mapping.
+        """
+        self[key] = value
+
+    def unsetenv(self, key):
+        """Remove a variable if it is set, like `os.unsetenv`"""
+        if key in self.environ:
+            del self[key]
+
+    def copy(self):
+        """Return a plain `dict` copy of the variables"""
+        return dict(self.environ)
+
+
+class Backend(object):
+    """Interface for remote sources of environment variables
+
+    Backends are wrapped in a `RemoteEnviron`, which caches their values, so
+    that an `Environment` can read them without waiting on the network.
+    """
+
+    def fetch(self, key):
+        """Fetch the value of a single variable
+
+        Raises:
+            KeyError: If the variable does not exist
+        """
+        raise NotImplementedError
+
+    def fetch_prefix(self, prefix):
+        """Fetch every variable starting with `prefix`
+
+        Returns:
+            `dict` mapping variable names to values
+        """
+        raise NotImplementedError
+
+    def close(self):
+        """Release any resources held by the backend"""
+        pass
+
+
+class HTTPBackend(Backend):
+    """Backend reading variables from an HTTP key-value store
+
+    The store must answer ``GET {url}/{key}`` with the value as the body, or
+    status 404 if the variable does not exist, and ``GET {url}/?prefix=...``
+    with a json object of every variable starting with the prefix.
+
+    Connections are kept alive and reused. At most `pool_size` requests are
+    made at the same time, further requests wait for a free connection.
+
+    Args:
+        url (`str`): Base url of the store, http or https
+        timeout (`float`): Seconds to wait for a connection or a response
+        pool_size (`int`): Maximum number of connections
+    """
+
+    def __init__(self, url, timeout=5.0, pool_size=4):
+        httplib = _import('http.client', 'httplib')
+        parts = urlparse.urlparse(url)
+        if parts.scheme == 'https':
+            self._connection_class = httplib.HTTPSConnection
+        elif parts.scheme == 'http':
+            self._connection_class = httplib.HTTPConnection
+        else:
+            msg = "Remote environment url '{}' must be http or https"
+            raise ImproperlyConfigured(msg.format(url))
+        self.url = url
+        self.timeout = timeout
+        self._netloc = parts.netloc
+        self._path = parts.path.rstrip('/')
+        # Free connections, with None for connections not opened yet
+        self._pool = _import('queue', 'Queue').Queue()
+        for _ in range(pool_size):
+            self._pool.put(None)
+
+    def fetch(self, key):
+        quote = _import('urllib.parse', 'urllib').quote
+        status, body = self._request('/' + quote(key, safe=''))
+        if status == 404:
+            raise KeyError(key)
+        return body.decode('utf-8')
+
+    def fetch_prefix(self, prefix):
+        query = _import('urllib.parse', 'urllib').urlencode({'prefix': prefix})
+        status, body = self._request('/?' + query)
+        return json.loads(body.decode('utf-8'))
+
+    def close(self):
+        queue = _import('queue', 'Queue')
+        while True:
+            try:
+                connection = self._pool.get_nowait()
+            except queue.Empty:
+                break
+            if connection is not None:
+                connection.close()
+
+    def _request(self, path):
+        queue = _import('queue', 'Queue')
+        try:
+            connection = self._pool.get(timeout=self.timeout)
+        except queue.Empty:
+            raise IOError('No free connection to {}'.format(self.url))
+        try:
+            if connection is None:
+                connection = self._connection_class(self._netloc,
+                                                    timeout=self.timeout)
+            connection.request('GET', self._path + path)
+            response = connection.getresponse()
+            body = response.read()
+        except Exception:
+            if connection is not None:
+                connection.close()
+            connection = None
+            raise
+        finally:
+            self._pool.put(connection)
+
+        if response.status not in (200, 404):
+            raise IOError('{} returned status {}'.format(self.url,
+                                                         response.status))
+        return response.status, body
+
+
+class RemoteEnviron(Mapping):
+    """Environ reading variables from a `Backend`, through a cache
+
+    Every variable is cached for `ttl` seconds after it was fetched. Once
+    expired, the cached value is still returned, and a background thread
+    fetches the new value (stale while revalidate). Only variables which
+    have never been read wait for the backend, so use `prefetch` to warm the
+    cache before serving requests.
+
+    `version` increases whenever a refresh changes a value, so caches built
+    on an `Environment` using this environ notice the change.
+
+    Examples:
+        >>> environ = RemoteEnviron(HTTPBackend('http://config/v1/myapp'))
+        >>> environ.prefetch()
+        >>> env = Environment(environ)
+
+    Args:
+        backend (`Backend`): Where to fetch variables from
+        ttl (`float`): Seconds before a cached value is refreshed
+
+    Attributes:
+        version (`int`): Number of values changed by refreshes
+    """
+
+    def __init__(self, backend, ttl=60.0):
+        self.backend = backend
+        self.ttl = ttl
+        self.version = 0
+        # Maps variables to (value, expiry), with NOTSET for missing values
+        self._cache = {}
+        self._pending = set()
+        self._queue = _import('queue', 'Queue').Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def __getitem__(self, key):
+        entry = self._cache.get(key)
+        if entry is None:
+            value = self._load(key)
+        else:
+            value, expires = entry
+            if expires <= _clock():
+                self._schedule(key)
+        if value is NOTSET:
+            raise KeyError(key)
+        return value
+
+    def __iter__(self):
+        return iter([key for key, (value, _) in list(self._cache.items())
+                     if value is not NOTSET])
+
+    def __len__(self):
+        return len(list(iter(self)))
+
+    def prefetch(self, prefix=''):
+        """Fetch every variable starting with `prefix` in a single request"""
+        try:
+            values = self.backend.fetch_prefix(prefix)
+        except Exception as e:
+            msg = "Could not fetch environment variables '{}*': {}"
+            raise ImproperlyConfigured(msg.format(prefix, e))
+        for key, value in values.items():
+            self._store(key, value)
+
+    def wait(self):
+        """Wait until all scheduled refreshes have finished"""
+        self._queue.join()
+
+    def close(self):
+        """Stop the refresh thread and close the backend"""
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+        self.backend.close()
+
+    def _load(self, key):
+        try:
+            value = self.backend.fetch(key)
+        except KeyError:
+            value = NOTSET
+        except Exception as e:
+            msg = "Could not fetch environment variable '{}': {}"
+            raise ImproperlyConfigured(msg.format(key, e))
+        self._store(key, value)
+        return value
+
+    def _store(self, key, value):
+        with self._lock:
+            previous = self._cache.get(key)
+            self._cache[key] = (value, _clock() + self.ttl)
+            if previous is not None and previous[0] != value:
+                self.version += 1
+
+    def _schedule(self, key):
+        with self._lock:
+            if key in self._pending:
+                return
+            self._pending.add(key)
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._refresh, name='envy-refresh')
+                self._thread.daemon = True
+                self._thread.start()
+        self._queue.put(key)
+
+    def _refresh(self):
+        while True:
+            key = self._queue.get()
+            try:
+                if key is None:
+                    return
+                try:
+                    self._store(key, self.backend.fetch(key))
+                except KeyError:
+                    self._store(key, NOTSET)
+                except Exception:
+                    # Keep serving the stale value until the next attempt
+                    logger.warning("Could not refresh environment variable "
+                                   "'%s'", key, exc_info=True)
+                    self._store(key, self._cache[key][0])
+            finally:
+                if key is not None:
+                    with self._lock:
+                        self._pending.discard(key)
+                self._queue.task_done()
+
+
+class Fingerprint(object):
+    """Stable hash of the values of a schema, updated incrementally
+
+    Created with `Environment.fingerprint`. Each variable is hashed on its
+    own, and only hashed again when its raw value has changed, or not at all
+    while the version of a versioned environ is unchanged.
+
+    Values are hashed from a canonical encoding of their type and contents,
+    with sets and dicts in sorted order. Values of other types are hashed by
+    their `repr`, which must be stable for the hash to be.
+
+    Args:
+        environment (`Environment`): The environment to read from
+        schema: The variables to hash, see `Environment.resolve`
+    """
+
+    def __init__(self, environment, schema):
+        self.environment = environment
+        self.entries = _normalize_schema(schema)
+        self._version = None
+        self._raw = {}
+        self._digests = {}
+        self._hexdigest = None
+
+    def __str__(self):
+        return self.hexdigest()
+
+    def __repr__(self):
+        return '<Fingerprint {}>'.format(self.hexdigest())
+
+    def hexdigest(self):
+        """The hash of the current values, as a hexadecimal string"""
+        environment = self.environment
+        if _override_depth and _override_layer(environment):
+            version = None
+        else:
+            version = environment.version
+        if version is not None and version == self._version:
+            return self._hexdigest
+
+        changed = self._hexdigest is None
+        for var, kwargs in self.entries:
+            raw = _raw_or_notset(environment, var)
+            if var in self._raw and self._raw[var] == raw:
+                continue
+            value = environment._get(var, **kwargs)
+            digest = hashlib.sha256(_canonical(var) +
+                                    _canonical(value)).digest()
+            if self._digests.get(var) != digest:
+                self._digests[var] = digest
+                changed = True
+            self._raw[var] = raw
+
+        if changed:
+            self._hexdigest = hashlib.sha256(b''.join(
+                self._digests[var] for var in sorted(self._digests)
+            )).hexdigest()
+        self._version = version
+        return self._hexdigest
+
+
+def _canonical(value):
+    # Encode a value with its type, independent of ordering in sets and
+    # dicts, and prefixed by its length so that encodings cannot run together
+    if value is None:
+        data = b'n'
+    elif isinstance(value, bool):
+        data = b'b1' if value else b'b0'
+    elif isinstance(value, (int, long)):
+        data = b'i' + str(value).encode('ascii')
+    elif isinstance(value, float):
+        data = b'f' + repr(value).encode('ascii')
+    elif isinstance(value, Decimal):
+        data = b'd' + str(value.normalize()).encode('ascii')
+    elif isinstance(value, text_type):
+        data = b's' + value.encode('utf-8')
+    elif isinstance(value, bytes):
+        data = b'y' + value
+        if str is bytes:
+            # Native strings are text on Python 2, as they are on Python 3
+            try:
+                value.decode('utf-8')
+            except UnicodeDecodeError:
+                pass
+            else:
+                data = b's' + value
+    elif isinstance(value, dict):
+        data = b'm' + b''.join(sorted(_canonical(k) + _canonical(v)
+                                      for k, v in value.items()))
+    elif isinstance(value, (set, frozenset)):
+        data = b'e' + b''.join(sorted(_canonical(item) for item in value))
+    elif isinstance(value, list):
+        data = b'l' + b''.join(_canonical(item) for item in value)
+    elif isinstance(value, tuple):
+        # Includes named tuples, such as parsed urls
+        data = (b't' + type(value).__name__.encode('utf-8') + b':' +
+                b''.join(_canonical(item) for item in value))
+    else:
+        data = b'r' + repr(value).encode('utf-8')
+    return str(len(data)).encode('ascii') + b':' + data
+
+
+class Snapshot(object):
+    """Cast values captured from an environment
+
+    Created with `Environment.snapshot`, and loaded with
+    `Environment.load_snapshot` or `init_worker`. Only the captured values,
+    the names of their casts and a hash of their raw values are pickled.
+
+    Args:
+        digest (`str`): Hash of the raw values the snapshot was taken from
+        values (`dict`): Maps variables to ``(cast name, value)`` pairs
+    """
+
+    __slots__ = ('digest', 'values')
+
+    def __init__(self, digest, values):
+        self.digest = digest
+        self.values = values
+
+    def __reduce__(self):
+        return (Snapshot, (self.digest, self.values))
+
+    def __repr__(self):
+        return '<Snapshot of {} variables>'.format(len(self.values))
+
+
+def init_worker(snapshot, environment=None):
+    """Initializer for process pools, loading a `Snapshot`
+
+    Pass it as the ``initializer`` of a `concurrent.futures`,
+    `multiprocessing` or Celery pool, so that children started with
+    ``spawn`` or ``forkserver`` do not cast every value again when they
+    import the settings.
+
+    Examples:
+        >>> snapshot = env.snapshot(SCHEMA)
+        >>> pool = ProcessPoolExecutor(initializer=init_worker,
+        ...                            initargs=(snapshot,))
+
+    Args:
+        snapshot (`Snapshot`): Values to load
+        environment (`Environment`): Environment to load them into, defaults
+            to `env`
+
+    Returns:
+        `bool`, whether the snapshot was loaded
+    """
+    return (environment or env).load_snapshot(snapshot)
+
+
+class Override(object):
+    """Context manager layering values on top of an environment
+
+    Created by `Environment.override`.
+
+    Args:
+        environment (`Environment`): The environment to override
+        values (`dict`): Values to override, with `None` for unset variables
+    """
+
+    def __init__(self, environment, values):
+        self.environment = environment
+        self.values = values
+        self._token = None
+
+    def __enter__(self):
+        global _override_depth
+
+        layers = _overrides.get() or {}
+        key = id(self.environment)
+        layer = dict(layers.get(key, ()))
+        layer.update(self.values)
+        layers = dict(layers)
+        layers[key] = layer
+        self._token = _overrides.set(layers)
+        with _override_lock:
+            _override_depth += 1
+        return self.environment
+
+    def __exit__(self, *exc_info):
+        global _override_depth
+
+        _overrides.reset(self._token)
+        self._token = None
+        with _override_lock:
+            _override_depth -= 1
+
+
+class _ThreadLocalVar(threading.local):
+    # Stand-in for contextvars.ContextVar before Python 3.7. Isolates
+    # threads, but not tasks.
+
+    def __init__(self, name, default=None):
+        self.value = default
+
+    def get(self):
+        return self.value
+
+    def set(self, value):
+        token, self.value = self.value, value
+        return token
+
+    def reset(self, token):
+        self.value = token
+
+
+if contextvars is not None:
+    _overrides = contextvars.ContextVar('envy_overrides', default=None)
+else:
+    _overrides = _ThreadLocalVar('envy_overrides')
+
+# Number of override blocks active in any thread or task, so that lookups can
+# skip the context variable entirely when there are none
+_override_depth = 0
+_override_lock = threading.Lock()
+
+
+def _override_layer(environment):
+    # Values overriding the environment in the current context, if any
+    layers = _overrides.get()
+    if layers:
+        return layers.get(id(environment))
+    return None
+
+
+def _layered(environ, layer, var):
+    # Read a variable from an override layer, falling back to the environ
+    if layer and var in layer:
+        value = layer[var]
+        if value is None:
+            raise KeyError(var)
+        return value
+    return environ[var]
+
+
+class Accessor(object):
+    """A lookup bound to its arguments, caching the value
+
+    Created with `Environment.accessor`.
+    """
+
+    __slots__ = ('environment', 'var', 'default', 'cast', 'force', '_state')
+
+    def __init__(self, environment, var, default=NOTSET, cast=None,
+                 force=True):
+        self.environment = environment
+        self.var = var
+        self.default = default
+        self.cast = cast
+        self.force = force
+        # Version, raw value, value and whether the value must be copied,
+        # replaced as a whole
+        self._state = (None, _unresolved, None, False)
+
+    def __call__(self):
+        version, _, value, mutable = self._state
+        if (version is None or _override_depth or
+                version != self.environment.version):
+            value, mutable = self._refresh()
+        elif _observers:
+            _notify('cache', 'accessor', True)
+        if mutable:
+            return _copy_mutable(value)
+        return value
+
+    def __repr__(self):
+        return '<Accessor {}>'.format(self.var)
+
+    def _refresh(self):
+        environment = self.environment
+        current = environment.version
+        _, previous, value, mutable = self._state
+        raw = _raw_or_notset(environment, self.var)
+        hit = raw is previous or raw == previous
+        if _observers:
+            _notify('cache', 'accessor', hit)
+        if not hit:
+            value = environment._get(self.var, self.default, self.cast,
+                                     self.force)
+            mutable = type(value) in (dict, list, set)
+        if _override_depth and _override_layer(environment):
+            # The version does not cover overrides
+            current = None
+        self._state = (current, raw, value, mutable)
+        return value, mutable
+
+
+# Marks an accessor which has not been read yet
+_unresolved = type(str('Unresolved'), (object,), {})
+
+
+class Derived(object):
+    """A value computed from one or more environment variables
+
+    Usually created with `Environment.derived`. The inputs are checked on
+    every call, with a single version comparison when the environ keeps a
+    version, and otherwise by comparing their raw values. The function is
+    only called again when an input has changed.
+
+    Args:
+        environment (`Environment`): The environment to read from
+        func: Function computing the value from the input values
+        schema: The inputs, see `Environment.resolve`
+    """
+
+    def __init__(self, environment, func, schema):
+        self.environment = environment
+        self.func = func
+        self.entries = _normalize_schema(schema)
+        # Version, raw inputs and value, replaced as a whole so that
+        # concurrent calls never see a value paired with the wrong inputs
+        self._state = (None, NOTSET, NOTSET)
+        self.__doc__ = getattr(func, '__doc__', None)
+
+    def __call__(self):
+        environment = self.environment
+        version, inputs, value = self._state
+        if _override_depth and _override_layer(environment):
+            # The version does not cover overrides, so compare raw values
+            current = None
+        else:
+            current = environment.version
+        if current is not None and current == version:
+            return value
+
+        raw = tuple(_raw_or_notset(environment, var)
+                    for var, _ in self.entries)
+        if raw != inputs:
+            value = self.func(*[environment._get(var, **kwargs)
+                                for var, kwargs in self.entries])
+        self._state = (current, raw, value)
+        return value
+
+    def __repr__(self):
+        return '<Derived {}>'.format(getattr(self.func, '__name__', '?'))
+
+
+class Overlay(Environment):
+    """Environment overriding a few variables of a base environment
+
+    Created with `Environment.overlay`. Variables which are not overridden
+    are read through the base, so that snapshots, interpolation and cast
+    defaults are cached once for every overlay. Overlays of an overlay
+    share the same base.
+
+    Reloading an overlay, or loading a snapshot into it, reloads the base or
+    loads the snapshot into the base.
+
+    Args:
+        base (`Environment`): The environment to read other variables from
+        values (`dict`): Values to override, with `None` for unset variables
+    """
+
+    # Only these are ever set, so that the instance dict inherited from
+    # Environment is never created
+    __slots__ = ('base', 'values')
+
+    def __init__(self, base, values):
+        if isinstance(base, Overlay):
+            values = dict(base.values, **values)
+            base = base.base
+        self.base = base
+        self.values = values
+
+    def __contains__(self, var):
+        if _override_depth:
+            layer = _override_layer(self)
+            if layer and var in layer:
+                return layer[var] is not None
+        if var in self.values:
+            return self.values[var] is not None
+        return var in self.base
+
+    def __repr__(self):
+        return '<Overlay {}>'.format(', '.join(sorted(self.values)))
+
+    @property
+    def environ(self):
+        return self.base.environ
+
+    @property
+    def environb(self):
+        return self.base.environb
+
+    @property
+    def interpolate(self):
+        return self.base.interpolate
+
+    @property
+    def max_size(self):
+        return self.base.max_size
+
+    @property
+    def max_items(self):
+        return self.base.max_items
+
+    @property
+    def version(self):
+        return self.base.version
+
+    @property
+    def _snapshot(self):
+        # Cached values are checked against the raw value, so the base
+        # snapshot is also valid for overridden variables
+        return self.base._snapshot
+
+    def reload(self):
+        self.base.reload()
+
+    def load_snapshot(self, snapshot):
+        return self.base.load_snapshot(snapshot)
+
+    def _get(self, var, default=NOTSET, cast=None, force=True, binary=False):
+        if (var not in self.values and not self.base.interpolate and
+                not (_override_depth and _override_layer(self))):
+            return self.base._get(var, default, cast, force, binary)
+        return Environment._get(self, var, default, cast, force, binary)
+
+    def _raw(self, var):
+        # Overrides of the base, then the overlay, then overrides of the
+        # overlay
+        layer = self.values
+        if _override_depth:
+            below = _override_layer(self.base)
+            above = _override_layer(self)
+            if below or above:
+                layer = dict(below or ())
+                layer.update(self.values)
+                layer.update(above or ())
+        if self.base.interpolate:
+            if var not in layer and layer is self.values:
+                # Use the memo of the base, unless the value references an
+                # overridden variable
+                base = self.base
+                try:
+                    value = base._expand(var, ())
+                    cached = base._expanded.get(var)
+                except ImproperlyConfigured:
+                    # The reference may only be set in the overlay
+                    cached = None
+                if cached is not None and not any(
+                        dep in layer for dep in cached[1]):
+                    return value
+            return self.base._expand(var, (), {}, layer)
+        if var in layer:
+            return _layered(None, layer, var)
+        return self.base._raw(var)
+
+    def _raw_bytes(self, var):
+        return _encode_raw(var, self._raw(var))
+
+
+def _cast_value(var, value, cast, max_items=None):
+    # Cast a value outside of an environment, for use on executors
+    environment = Environment({})
+    environment.max_items = max_items
+    return environment._cast(var, value, cast)
+
+
+def _raw_or_notset(environment, var):
+    try:
+        return environment._raw(var)
+    except KeyError:
+        return NOTSET
+
+
+class Lookup(object):
+    """A single read of an environment variable
+
+    Passed to observers, such as `Profile`, after every lookup.
+
+    Args:
+        environment (`Environment`): The environment that was read
+        var (`str`): The name of the environment variable
+        default: The default passed to the lookup
+        cast: The cast passed to the lookup
+        source (`str`): ``'environ'`` if the variable was set, ``'default'``
+            if the default was used and ``'missing'`` if neither was available
+        start (`float`): Clock value when the lookup started
+        duration (`float`): Seconds spent reading and casting the variable
+        error: The exception raised by the lookup, if any
+        force (`bool`): Whether the default is cast
+    """
+
+    __slots__ = ('environment', 'var', 'default', 'cast', 'source', 'start',
+                 'duration', 'error', 'force')
+
+    def __init__(self, environment, var, default, cast, source, start,
+                 duration, error=None, force=True):
+        self.environment = environment
+        self.var = var
+        self.default = default
+        self.cast = cast
+        self.source = source
+        self.start = start
+        self.duration = duration
+        self.error = error
+        self.force = force
+
+
+class Observer(object):
+    """Base class for objects notified of every environment lookup
+
+    Subclasses implement ``__call__``, which receives a `Lookup`, and can
+    implement `cache` and `reloaded` to be notified of other events. Observers
+    can be started and stopped explicitly, or used as context managers.
+    """
+
+    def __call__(self, lookup):
+        raise NotImplementedError
+
+    def wants_lookup(self):
+        """Called before each lookup, to check whether to record it
+
+        Lookups which no observer wants are not timed or recorded.
+
+        Returns:
+            `bool`
+        """
+        return True
+
+    def cache(self, name, hit):
+        """Called when a cache is checked
+
+        Args:
+            name (`str`): The cache, one of ``'defaults'``, ``'snapshot'``,
+                ``'compiled'``, ``'accessor'`` and ``'compressed'``
+            hit (`bool`): Whether a cached value was used
+        """
+        pass
+
+    def reloaded(self, environment, duration):
+        """Called after `Environment.reload`
+
+        Args:
+            environment (`Environment`): The environment reloaded
+            duration (`float`): Seconds spent reloading
+        """
+        pass
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def start(self):
+        """Start observing lookups"""
+        if self not in _observers:
+            _observers.append(self)
+        return self
+
+    def stop(self):
+        """Stop observing lookups"""
+        if self in _observers:
+            _observers.remove(self)
+
+
+class Profile(Observer):
+    """Records every environment lookup while active
+
+    Usually created through `profile`, and used as a context manager around
+    code that reads the environment, such as the import of a Django settings
+    module.
+
+    Examples:
+        >>> with profile() as report:
+        ...     import myproject.settings
+        >>> report.print_table()
+
+    Attributes:
+        records (`list`): One `dict` per lookup, with the keys ``var``,
+            ``cast``, ``source``, ``site``, ``start``, ``duration``,
+            ``thread`` and ``error``
+    """
+
+    def __init__(self):
+        self.records = []
+        self._lock = threading.Lock()
+
+    def __call__(self, lookup):
+        record = {
+            'var': lookup.var,
+            'cast': _cast_name(lookup.cast),
+            'source': lookup.source,
+            'site': _call_site(),
+            'start': lookup.start,
+            'duration': lookup.duration,
+            'thread': threading.current_thread().ident,
+            'error': str(lookup.error) if lookup.error else None,
+        }
+        with self._lock:
+            self.records.append(record)
+
+    @property
+    def total(self):
+        """Total number of seconds spent in lookups"""
+        return sum(r['duration'] for r in self.records)
+
+    def format_table(self):
+        """Format the recorded lookups as a table, slowest first
+
+        Returns:
+            `str`
+        """
+        header = ('ms', 'variable', 'cast', 'source', 'site')
+        rows = [('{:.3f}'.format(r['duration'] * 1000), r['var'], r['cast'],
+                 r['source'], r['site'])
+                for r in sorted(self.records, key=lambda r: -r['duration'])]
+        rows.append(('{:.3f}'.format(self.total * 1000),
+                     '({} lookups)'.format(len(self.records)), '', '', ''))
+        widths = [max(len(row[i]) for row in [header] + rows)
+                  for i in range(len(header))]
+        lines = ['  '.join(cell.ljust(width)
+                           for cell, width in zip(row, widths)).rstrip()
+                 for row in [header] + rows]
+        return '\n'.join(lines)
+
+    def print_table(self, file=None):
+        """Print the table from `format_table`, to stdout by default"""
+        print(self.format_table(), file=file or sys.stdout)
+
+    def to_chrome_trace(self):
+        """Convert the recorded lookups to Chrome trace events
+
+        The result can be serialized with `json.dump` and loaded in
+        ``chrome://tracing`` or Perfetto.
+
+        Returns:
+            `dict`
+        """
+        pid = os.getpid()
+        events = []
+        for r in self.records:
+            events.append({
+                'name': r['var'],
+                'cat': 'envy',
+                'ph': 'X',
+                'ts': r['start'] * 1e6,
+                'dur': r['duration'] * 1e6,
+                'pid': pid,
+                'tid': r['thread'],
+                'args': {
+                    'cast': r['cast'],
+                    'source': r['source'],
+                    'site': r['site'],
+                    'error': r['error'],
+                },
+            })
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def dump_chrome_trace(self, fp):
+        """Write the output of `to_chrome_trace` as json to a file object"""
+        json.dump(self.to_chrome_trace(), fp)
+
+
+class Metrics(Observer):
+    """Collects lookup metrics for export in the OpenMetrics format
+
+    Counts lookups per variable and cast, defaults used, cache hits and
+    misses, and reloads, and records histograms of lookup and reload
+    durations. Each thread counts in its own shard, without locking, and the
+    shards are merged when the metrics are collected.
+
+    Examples:
+        >>> metrics = Metrics().start()
+        >>> print(metrics.to_openmetrics())
+
+    Args:
+        sample (`int`): Record the duration of every n-th lookup per thread
+        buckets: Upper bounds of the histogram buckets, in seconds
+    """
+
+    default_buckets = (1e-05, 5e-05, 0.0001, 0.0005, 0.001, 0.005, 0.01,
+                       0.05, 0.1, 0.5, 1.0)
+
+    def __init__(self, sample=1, buckets=None):
+        self.sample = sample
+        self.buckets = tuple(buckets or self.default_buckets)
+        self._local = threading.local()
+        self._shards = []
+        self._lock = threading.Lock()
+
+    def __call__(self, lookup):
+        shard = self._shard()
+        name = _cast_name(lookup.cast)
+        key = (lookup.var, name)
+        shard.lookups[key] = shard.lookups.get(key, 0) + 1
+        if lookup.source == 'default':
+            shard.defaults[lookup.var] = shard.defaults.get(lookup.var, 0) + 1
+        shard.calls += 1
+        if shard.calls % self.sample == 0:
+            self._observe(shard.durations, name, lookup.duration)
+
+    def cache(self, name, hit):
+        shard = self._shard()
+        key = (name, 'hit' if hit else 'miss')
+        shard.cache[key] = shard.cache.get(key, 0) + 1
+
+    def reloaded(self, environment, duration):
+        self._observe(self._shard().reloads, '', duration)
+
+    def collect(self):
+        """Merge the metrics from all threads
+
+        Returns:
+            `dict` with the keys ``lookups``, ``defaults`` and ``cache``,
+            mapping labels to counts, and ``durations`` and ``reloads``,
+            mapping labels to histograms. Histograms are ``[bucket counts,
+            count, sum]`` lists, with non-cumulative bucket counts and a last
+            bucket for values above all bounds.
+        """
+        merged = {'lookups': {}, 'defaults': {}, 'cache': {},
+                  'durations': {}, 'reloads': {}}
+        with self._lock:
+            shards = list(self._shards)
+        for shard in shards:
+            for metric in ('lookups', 'defaults', 'cache'):
+                counts = merged[metric]
+                for key, count in list(getattr(shard, metric).items()):
+                    counts[key] = counts.get(key, 0) + count
+            for metric in ('durations', 'reloads'):
+                histograms = merged[metric]
+                for key, (buckets, count, total) in list(
+                        getattr(shard, metric).items()):
+                    histogram = histograms.setdefault(
+                        key, [[0] * len(buckets), 0, 0.0])
+                    histogram[0] = [a + b for a, b in zip(histogram[0],
+                                                          buckets)]
+                    histogram[1] += count
+                    histogram[2] += total
+        return merged
+
+    def to_openmetrics(self):
+        """Format the metrics in the OpenMetrics text format
+
+        Returns:
+            `str`
+        """
+        data = self.collect()
+        lines = []
+
+        def counter(name, description, labels, counts):
+            lines.append('# TYPE {} counter'.format(name))
+            lines.append('# HELP {} {}'.format(name, description))
+            for key, count in sorted(counts.items()):
+                lines.append('{}_total{} {}'.format(
+                    name, _labels(zip(labels, key)), count))
+
+        def histogram(name, description, label, histograms):
+            lines.append('# TYPE {} histogram'.format(name))
+            lines.append('# HELP {} {}'.format(name, description))
+            for key, (buckets, count, total) in sorted(histograms.items()):
+                pairs = [(label, key)] if label else []
+                cumulative = 0
+                bounds = [repr(float(b)) for b in self.buckets] + ['+Inf']
+                for bound, bucket in zip(bounds, buckets):
+                    cumulative += bucket
+                    lines.append('{}_bucket{} {}'.format(
+                        name, _labels(pairs + [('le', bound)]), cumulative))
+                lines.append('{}_count{} {}'.format(
+                    name, _labels(pairs), count))
+                lines.append('{}_sum{} {!r}'.format(
+                    name, _labels(pairs), total))
+
+        counter('envy_lookups', 'Environment variable lookups.',
+                ('var', 'cast'), data['lookups'])
+        histogram('envy_lookup_seconds', 'Time spent reading and casting '
+                  'environment variables.', 'cast', data['durations'])
+        counter('envy_defaults', 'Lookups using the default value.',
+                ('var',), {(var,): count
+                           for var, count in data['defaults'].items()})
+        counter('envy_cache', 'Cache hits and misses.', ('cache', 'result'),
+                data['cache'])
+        reloads = data['reloads'].get('', [[0] * (len(self.buckets) + 1),
+                                           0, 0.0])
+        lines.append('# TYPE envy_reloads counter')
+        lines.append('# HELP envy_reloads Environment reloads.')
+        lines.append('envy_reloads_total {}'.format(reloads[1]))
+        histogram('envy_reload_seconds', 'Time spent reloading environments.',
+                  None, {'': reloads})
+        lines.append('# EOF')
+        return '\n'.join(lines) + '\n'
+
+    def collector(self):
+        """Adapter for registering the metrics with prometheus_client
+
+        Examples:
+            >>> from prometheus_client import REGISTRY
+            >>> REGISTRY.register(metrics.collector())
+
+        Returns:
+            A collector for `prometheus_client.CollectorRegistry.register`
+        """
+        return _PrometheusCollector(self)
+
+    def _shard(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = _MetricsShard()
+            with self._lock:
+                self._shards.append(shard)
+            return shard
+
+    def _observe(self, histograms, key, value):
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = [[0] * (len(self.buckets) + 1),
+                                           0, 0.0]
+        histogram[0][bisect.bisect_left(self.buckets, value)] += 1
+        histogram[1] += 1
+        histogram[2] += value
+
+
+class _MetricsShard(object):
+    # Metrics collected by a single thread
+
+    def __init__(self):
+        self.calls = 0
+        self.lookups = {}
+        self.defaults = {}
+        self.cache = {}
+        self.durations = {}
+        self.reloads = {}
+
+
+class _PrometheusCollector(object):
+    # Exposes Metrics as prometheus_client metric families
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+
+    def collect(self):
+        from prometheus_client.core import (
+            CounterMetricFamily, HistogramMetricFamily)
+
+        metrics = self.metrics
+        data = metrics.collect()
+        bounds = [repr(float(b)) for b in metrics.buckets] + ['+Inf']
+
+        def histogram_buckets(buckets):
+            cumulative = []
+            total = 0
+            for bound, bucket in zip(bounds, buckets):
+                total += bucket
+                cumulative.append((bound, total))
+            return cumulative
+
+        lookups = CounterMetricFamily(
+            'envy_lookups', 'Environment variable lookups.',
+            labels=('var', 'cast'))
+        for key, count in data['lookups'].items():
+            lookups.add_metric(key, count)
+        yield lookups
+
+        durations = HistogramMetricFamily(
+            'envy_lookup_seconds',
+            'Time spent reading and casting environment variables.',
+            labels=('cast',))
+        for key, (buckets, count, total) in data['durations'].items():
+            durations.add_metric((key,), histogram_buckets(buckets), total)
+        yield durations
+
+        defaults = CounterMetricFamily(
+            'envy_defaults', 'Lookups using the default value.',
+            labels=('var',))
+        for var, count in data['defaults'].items():
+            defaults.add_metric((var,), count)
+        yield defaults
+
+        cache = CounterMetricFamily(
+            'envy_cache', 'Cache hits and misses.',
+            labels=('cache', 'result'))
+        for key, count in data['cache'].items():
+            cache.add_metric(key, count)
+        yield cache
+
+        reloads = data['reloads'].get('')
+        yield CounterMetricFamily('envy_reloads', 'Environment reloads.',
+                                  value=reloads[1] if reloads else 0)
+        if reloads:
+            histogram = HistogramMetricFamily(
+                'envy_reload_seconds', 'Time spent reloading environments.')
+            histogram.add_metric((), histogram_buckets(reloads[0]),
+                                 reloads[2])
+            yield histogram
+
+
+def _labels(pairs):
+    # Format OpenMetrics labels, escaping values
+    pairs = list(pairs)
+    if not pairs:
+        return ''
+    return '{{{}}}'.format(','.join(
+        '{}="{}"'.format(name, text_type(value).replace('\\', '\\\\')
+                         .replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in pairs))
+
+
+def _notify(event, *args):
+    # Call an event method on every observer
+    for observer in list(_observers):
+        getattr(observer, event)(*args)
+
+
+class DebugLog(Observer):
+    """Logs each lookup as a structured debug record
+
+    Records are logged to the ``envy`` logger, and carry the variable, where
+    the value came from, whether the default was used, the cast and the
+    duration as ``envy_*`` attributes. Values are never logged, and errors
+    are only logged by their type, since their messages can contain values.
+
+    Like other observers, this costs nothing while it is not started. Once
+    started, the logger level and the sample are checked in `wants_lookup`,
+    so lookups which are not logged are not timed or recorded either.
+    Usually started with `log_lookups`.
+
+    Args:
+        sample (`float`): Fraction of lookups to log, between 0 and 1
+    """
+
+    def __init__(self, sample=1.0):
+        self.sample = sample
+
+    def wants_lookup(self):
+        if not logger.isEnabledFor(logging.DEBUG):
+            return False
+        return self.sample >= 1 or random.random() < self.sample
+
+    def __call__(self, lookup):
+        cast = _cast_name(lookup.cast)
+        error = type(lookup.error).__name__ if lookup.error else None
+        logger.debug(
+            "Read environment variable '%s' from %s as %s in %.3f ms%s",
+            lookup.var, lookup.source, cast, lookup.duration * 1000,
+            ' ({})'.format(error) if error else '',
+            extra={
+                'envy_var': lookup.var,
+                'envy_source': lookup.source,
+                'envy_default_used': lookup.source == 'default',
+                'envy_cast': cast,
+                'envy_duration': lookup.duration,
+                'envy_error': error,
+            })
+
+
+_debug_log = None
+
+
+def log_lookups(sample=1.0):
+    """Start logging every lookup for the whole process
+
+    See `DebugLog`. Can also be enabled by setting ``ENVY_DEBUG_LOG`` to
+    ``true``, or to the fraction of lookups to log, such as ``0.01``.
+
+    Args:
+        sample (`float`): Fraction of lookups to log, between 0 and 1
+
+    Returns:
+        The process wide `DebugLog`
+    """
+    global _debug_log
+
+    if _debug_log is None:
+        _debug_log = DebugLog(sample)
+    _debug_log.sample = sample
+    return _debug_log.start()
+
+
+def profile():
+    """Profile environment lookups
+
+    Can also be enabled for the whole process by setting ``ENVY_PROFILE`` to
+    ``true`` or ``table``, printing a table to stderr at exit, or to the file
+    name of a Chrome trace. ``0``, ``false`` and ``no`` leave it disabled.
+
+    Returns:
+        A new `Profile`, which records lookups while used as a context
+        manager
+    """
+    return Profile()
+
+
+class Tracker(Observer):
+    """Counts reads of environment variables while active
+
+    Used to find variables which are set but never read, variables which are
+    read over and over with the same cast, and variables falling back to
+    their defaults. Usually started once through `track`, before the Django
+    settings are imported.
+
+    Attributes:
+        reads (`dict`): Maps each variable to a `dict` of the number of
+            reads per cast name
+        defaults (`dict`): Maps each variable to the number of times its
+            default was used
+    """
+
+    def __init__(self):
+        self.reads = {}
+        self.defaults = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, lookup):
+        name = _cast_name(lookup.cast)
+        with self._lock:
+            counts = self.reads.setdefault(lookup.var, {})
+            counts[name] = counts.get(name, 0) + 1
+            if lookup.source == 'default':
+                self.defaults[lookup.var] = \
+                    self.defaults.get(lookup.var, 0) + 1
+
+    def unused(self, environ=None, prefixes=('',)):
+        """Variables which are set, but were never read
+
+        Args:
+            environ (`dict`): Environment to compare against, defaults to
+                `os.environ`
+            prefixes: Only consider variables starting with one of these
+
+        Returns:
+            Sorted `list` of variable names
+        """
+        environ = os.environ if environ is None else environ
+        return sorted(var for var in environ
+                      if var not in self.reads and
+                      any(var.startswith(p) for p in prefixes))
+
+    def repeated(self, threshold=2):
+        """Variables read at least `threshold` times with the same cast
+
+        These are candidates for reading once and keeping the value around.
+
+        Returns:
+            Sorted `list` of ``(var, cast name, count)`` tuples, most read
+            first
+        """
+        found = [(var, name, count)
+                 for var, counts in self.reads.items()
+                 for name, count in counts.items()
+                 if count >= threshold]
+        return sorted(found, key=lambda item: (-item[2], item[0]))
+
+    def defaulted(self):
+        """Variables which fell back to their default
+
+        Returns:
+            Sorted `list` of variable names
+        """
+        return sorted(self.defaults)
+
+    def check(self, environ=None, prefixes=('',), threshold=2,
+              include_defaults=True):
+        """Describe all findings as Django system check warnings
+
+        Requires Django.
+
+        Returns:
+            `list` of `django.core.checks.Warning`
+        """
+        from django.core.checks import Warning
+
+        messages = []
+        for var in self.unused(environ, prefixes):
+            messages.append(Warning(
+                "Environment variable '{}' is set but never read".format(var),
+                hint="Remove it from the environment",
+                id='envy.W001'))
+        for var, name, count in self.repeated(threshold):
+            messages.append(Warning(
+                "Environment variable '{}' was read {} times as {}".format(
+                    var, count, name),
+                hint="Read it once and reuse the value",
+                id='envy.W002'))
+        if include_defaults:
+            for var in self.defaulted():
+                messages.append(Warning(
+                    "Environment variable '{}' is not set, "
+                    "so the default was used".format(var),
+                    hint="Set it explicitly in the environment",
+                    id='envy.W003'))
+        return messages
+
+
+_tracker = Tracker()
+
+
+def track():
+    """Start tracking environment variable reads for the whole process
+
+    Call this before the settings are imported, then register `check_usage`
+    as a Django system check, or inspect the returned `Tracker` directly.
+
+    Returns:
+        The process wide `Tracker`
+    """
+    return _tracker.start()
+
+
+def check_usage(app_configs=None, **kwargs):
+    """Django system check reporting findings from `track`
+
+    Register it with ``django.core.checks.register(envy.check_usage)``. The
+    following settings are used:
+
+    * ``ENVY_UNUSED_PREFIXES``: Only report unused variables starting with
+      one of these prefixes. Unused variables are not reported if unset.
+    * ``ENVY_REPEATED_READS``: Report variables read this many times with
+      the same cast, defaults to 10.
+
+    Variables using their defaults are only reported when ``DEBUG`` is off.
+    """
+    from django.conf import settings
+
+    if _tracker not in _observers:
+        return []
+    return _tracker.check(
+        prefixes=getattr(settings, 'ENVY_UNUSED_PREFIXES', ()),
+        threshold=getattr(settings, 'ENVY_REPEATED_READS', 10),
+        include_defaults=not settings.DEBUG)
+
+
+class SharedConfig(object):
+    """Resolved values shared between processes through shared memory
+
+    One process resolves the configuration and publishes it with `create`,
+    or `Environment.share`. Other processes on the same host `attach` to the
+    segment by name and read the values, instead of resolving them again.
+
+    Each publish increments a version counter in the segment. Readers compare
+    it against the version they last read, so that unchanged values are
+    returned without deserializing them, and a new publish is picked up as a
+    whole. Values are serialized with `pickle`, so only share segments
+    between processes which trust each other.
+
+    Requires Python 3.8 or newer.
+
+    Args:
+        segment: The `multiprocessing.shared_memory.SharedMemory` to use
+    """
+
+    # Version and payload length, followed by the payload
+    _header = struct.Struct(str('QQ'))
+
+    def __init__(self, segment):
+        self.segment = segment
+        self._version = None
+        self._values = None
+
+    @classmethod
+    def create(cls, name, values, size=None):
+        """Create a new segment and publish `values` to it
+
+        Args:
+            name (`str`): Name of the segment
+            values (`dict`): Values to publish
+            size (`int`): Capacity of the segment in bytes. Defaults to twice
+                the size of `values`, leaving room for later publishes.
+
+        Returns:
+            `SharedConfig`
+        """
+        import pickle
+
+        shared_memory = _require_shared_memory()
+        payload = pickle.dumps(values, pickle.HIGHEST_PROTOCOL)
+        if size is None:
+            size = cls._header.size + max(2 * len(payload), 4096)
+        segment = shared_memory.SharedMemory(name=name, create=True,
+                                             size=size)
+        _created_segments.add(segment.name)
+        cls._header.pack_into(segment.buf, 0, 0, 0)
+        config = cls(segment)
+        config._write(payload)
+        return config
+
+    @classmethod
+    def attach(cls, name):
+        """Attach to an existing segment
+
+        Args:
+            name (`str`): Name of the segment
+
+        Returns:
+            `SharedConfig`
+        """
+        shared_memory = _require_shared_memory()
+        try:
+            segment = shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:
+            # Before Python 3.13, attaching registers the segment with the
+            # resource tracker, which would unlink it when this process exits
+            if os.name != 'posix':
+                # Windows, which has no resource tracker
+                segment = shared_memory.SharedMemory(name=name)
+            else:
+                segment = _AttachedSegment(name)
+        return cls(segment)
+
+    @property
+    def name(self):
+        """Name of the segment"""
+        return self.segment.name
+
+    @property
+    def version(self):
+        """Number of times values have been published to the segment"""
+        return self._header.unpack_from(self.segment.buf, 0)[0] // 2
+
+    def publish(self, values):
+        """Replace the values in the segment
+
+        Args:
+            values (`dict`): Values to publish
+
+        Raises:
+            ImproperlyConfigured: If the values do not fit in the segment
+        """
+        import pickle
+
+        self._write(pickle.dumps(values, pickle.HIGHEST_PROTOCOL))
+
+    def read(self):
+        """Read the published values
+
+        Returns:
+            `dict` of the values last published
+        """
+        return _copy_mutable(self._read())
+
+    def get(self, var, default=NOTSET):
+        """Read a single published value
+
+        Raises:
+            ImproperlyConfigured: If the value is missing and there is no
+                default
+        """
+        try:
+            return _copy_mutable(self._read()[var])
+        except KeyError:
+            if default is NOTSET:
+                msg = "Set the environment variable '{}'".format(var)
+                raise ImproperlyConfigured(msg)
+            return default
+
+    def close(self):
+        """Detach from the segment"""
+        self._values = None
+        self.segment.close()
+
+    def unlink(self):
+        """Remove the segment, once every process has closed it"""
+        self.segment.unlink()
+        _created_segments.discard(self.name)
+
+    def _read(self):
+        # The published values, unpickled again only after a publish
+        import pickle
+
+        buf = self.segment.buf
+        while True:
+            # The version is odd while a publish is in progress, and changes
+            # if one finished while the payload was being read
+            version, length = self._header.unpack_from(buf, 0)
+            if version == self._version:
+                return self._values
+            if version % 2:
+                time.sleep(0)
+                continue
+            start = self._header.size
+            payload = bytes(buf[start:start + length])
+            if self._header.unpack_from(buf, 0)[0] == version:
+                break
+
+        self._values = pickle.loads(payload)
+        self._version = version
+        return self._values
+
+    def _write(self, payload):
+        buf = self.segment.buf
+        start = self._header.size
+        if start + len(payload) > self.segment.size:
+            msg = ("Configuration of {} bytes does not fit in shared memory "
+                   "segment '{}' of {} bytes")
+            raise ImproperlyConfigured(msg.format(
+                len(payload), self.name, self.segment.size - start))
+
+        version = self._header.unpack_from(buf, 0)[0]
+        self._header.pack_into(buf, 0, version + 1, 0)
+        buf[start:start + len(payload)] = payload
+        self._header.pack_into(buf, 0, version + 2, len(payload))
+
+
+class _AttachedSegment(object):
+    # A POSIX shared memory segment opened without registering it with the
+    # resource tracker, like SharedMemory(name, track=False) on Python 3.13
+
+    def __init__(self, name):
+        import _posixshmem
+        import mmap
+
+        self.name = name
+        fd = _posixshmem.shm_open('/' + name, os.O_RDWR, mode=0o600)
+        try:
+            self.size = os.fstat(fd).st_size
+            self._mmap = mmap.mmap(fd, self.size)
+        finally:
+            os.close(fd)
+        self.buf = memoryview(self._mmap)
+
+    def close(self):
+        self.buf.release()
+        self._mmap.close()
+
+    def unlink(self):
+        import _posixshmem
+
+        _posixshmem.shm_unlink('/' + self.name)
+        if self.name in _created_segments:
+            # Created by this process, and registered with the tracker then
+            from multiprocessing import resource_tracker
+            resource_tracker.unregister('/' + self.name, 'shared_memory')
+
+
+# Names of the segments created by this process
+_created_segments = set()
+
+
+def _require_shared_memory():
+    try:
+        from multiprocessing import shared_memory
+    except ImportError:
+        msg = "Sharing configuration requires Python 3.8 or newer"
+        raise ImproperlyConfigured(msg)
+    return shared_memory
+
+
+def _normalize_schema(schema):
+    # Convert a schema to a list of (var, kwargs) pairs for Environment._get
+    if isinstance(schema, dict):
+        items = schema.items()
+    else:
+        items = [(item, None) if isinstance(item, string_types) else item
+                 for item in schema]
+
+    entries = []
+    for var, spec in items:
+        if spec is None:
+            kwargs = {}
+        elif (isinstance(spec, dict) and
+                all(key in ('default', 'cast', 'force') for key in spec)):
+            kwargs = dict(spec)
+        else:
+            kwargs = {'cast': spec}
+        entries.append((var, kwargs))
+    return entries
+
+
+def _import_string(path):
+    # Import an object from a 'package.module:attribute' string. Without an
+    # attribute, the module itself is returned.
+    module, _, attr = path.partition(':')
+    obj = importlib.import_module(module)
+    for name in filter(None, attr.split('.')):
+        obj = getattr(obj, name)
+    return obj
+
+
+def _is_identifier(name):
+    return (re.match(r'^[A-Za-z_][A-Za-z0-9_]*$', name) is not None and
+            not keyword.iskeyword(name))
+
+
+def _literal(var, value):
+    # Python source for a value, verified to evaluate back to an equal value
+    if isinstance(value, (set, frozenset)):
+        items = sorted(_literal(var, item) for item in value)
+        if not items:
+            source = '{}()'.format(type(value).__name__)
+        elif isinstance(value, frozenset):
+            source = 'frozenset({{{}}})'.format(', '.join(items))
+        else:
+            source = '{{{}}}'.format(', '.join(items))
+    else:
+        source = repr(value)
+
+    namespace = {'Decimal': Decimal, 'ParseResult': urlparse.ParseResult}
+    try:
+        ok = eval(source, namespace) == value
+    except Exception:
+        ok = False
+    if not ok:
+        msg = ("Environment variable '{}' cannot be compiled: "
+               "{} is not a Python literal")
+        raise ImproperlyConfigured(msg.format(var, type(value)))
+    return source
+
+
+def main(argv=None):
+    """Command line interface, available as ``envy`` and ``python -m envy``
+
+    Most commands take a TARGET, which is either a schema, given as
+    ``package.module:attribute``, or a settings module, given as
+    ``package.module``. Settings modules are imported, and the variables they
+    read are used as the schema. While importing them, variables which
+    cannot be read are recorded and read as their default, or `None`, so
+    that the errors of every variable are reported. Settings which cannot
+    work with such values can stop the import early, and then only the
+    errors found until then are reported.
+
+    Commands:
+        ``check TARGET``: Read every variable, and report all errors.
+        ``dump TARGET``: Print every value, with secrets redacted.
+        ``timing TARGET``: Print the time spent reading each variable, and
+        the time spent importing a settings module.
+        ``compile SCHEMA OUTPUT``: Write the schema found at SCHEMA to the
+        module OUTPUT. See `Environment.compile_module`.
+
+    Returns:
+        Exit status
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog='envy', description='Environment variable tools for Django')
+    commands = parser.add_subparsers(dest='command')
+    target_help = 'package.module:attribute or settings module'
+    check_parser = commands.add_parser(
+        'check', help='Read every variable, and report all errors')
+    check_parser.add_argument('target', help=target_help)
+    check_parser.set_defaults(handler=_command_check)
+    dump_parser = commands.add_parser(
+        'dump', help='Print every value, with secrets redacted')
+    dump_parser.add_argument('target', help=target_help)
+    dump_parser.add_argument('--show-secrets', action='store_true',
+                             help='Do not redact secrets')
+    dump_parser.set_defaults(handler=_command_dump)
+    timing_parser = commands.add_parser(
+        'timing', help='Print the time spent reading each variable')
+    timing_parser.add_argument('target', help=target_help)
+    timing_parser.set_defaults(handler=_command_timing)
+    compile_parser = commands.add_parser(
+        'compile', help='Write resolved values to a Python module')
+    compile_parser.add_argument('schema', help='package.module:attribute')
+    compile_parser.add_argument('output', help='File name of the module')
+    compile_parser.set_defaults(handler=_command_compile)
+    args = parser.parse_args(argv)
+
+    if args.command is None:
+        parser.print_help()
+        return 2
+
+    sys.path.insert(0, os.getcwd())
+    try:
+        return args.handler(args)
+    except ImproperlyConfigured as e:
+        print('error: {}'.format(e), file=sys.stderr)
+        return 1
+
+
+def _command_check(args):
+    schema, _, _ = _load_target(args.target)
+    env.resolve(schema)
+    print('{} variables OK'.format(len(schema)))
+    return 0
+
+
+def _command_dump(args):
+    schema, _, _ = _load_target(args.target)
+    values = env.resolve(schema)
+    for var in sorted(values):
+        value = values[var]
+        if not args.show_secrets:
+            value = _redact(var, value)
+        print('{}={!r}'.format(var, value))
+    return 0
+
+
+def _command_timing(args):
+    schema, elapsed, report = _load_target(args.target)
+    if report is None:
+        start = _clock()
+        with profile() as report:
+            env.resolve(schema)
+        elapsed = _clock() - start
+    report.print_table()
+    print('')
+    print('Total {:.3f} ms, of which {:.3f} ms reading {} variables'.format(
+        elapsed * 1000, report.total * 1000, len(report.records)))
+    return 0
+
+
+def _command_compile(args):
+    schema = _import_target(args.schema)
+    env.compile_module(schema, args.output)
+    print('Wrote {} variables to {}'.format(len(schema), args.output))
+    return 0
+
+
+class _SchemaRecorder(Observer):
+    # Builds a schema from the lookups made while importing settings
+
+    def __init__(self):
+        self.schema = []
+        self._seen = set()
+
+    def __call__(self, lookup):
+        if lookup.environment is env and lookup.var not in self._seen:
+            self._seen.add(lookup.var)
+            kwargs = {'cast': lookup.cast}
+            if lookup.default is not NOTSET:
+                kwargs['default'] = lookup.default
+            if not lookup.force:
+                kwargs['force'] = False
+            self.schema.append((lookup.var, kwargs))
+
+
+def _load_target(target):
+    # Find the schema for a command line target. Settings modules are
+    # imported while profiled, returning the schema they read, the time
+    # spent importing them and the profile.
+    if ':' in target:
+        return _normalize_schema(_import_target(target)), None, None
+
+    failed = []
+
+    def get(var, default=NOTSET, cast=None, force=True, binary=False):
+        # Keep importing after a lookup fails, so that all errors are found
+        try:
+            return Environment._get(env, var, default, cast, force, binary)
+        except ImproperlyConfigured:
+            failed.append(var)
+            return None if default is NOTSET else default
+
+    start = _clock()
+    env._get = get
+    try:
+        with _SchemaRecorder() as recorder, profile() as report:
+            _import_target(target)
+    except ImproperlyConfigured:
+        # Settings may fail on the values standing in for failed lookups,
+        # which are reported when the schema is read again
+        if not failed:
+            raise
+    finally:
+        del env._get
+    return recorder.schema, _clock() - start, report
+
+
+def _import_target(path):
+    # Import a command line target, turning failures into errors reported
+    # without a traceback
+    try:
+        return _import_string(path)
+    except ImproperlyConfigured:
+        raise
+    except Exception as e:
+        msg = "Could not import '{}': {}: {}"
+        raise ImproperlyConfigured(msg.format(path, type(e).__name__, e))
+
+
+# Names of variables which are redacted by the dump command
+_secret = re.compile(r'SECRET|PASSWORD|PASSWD|TOKEN|KEY|CREDENTIAL|PRIVATE',
+                     re.IGNORECASE)
+
+
+def _redact(var, value):
+    # Hide secrets in values printed by the command line interface, and in
+    # the collections they contain
+    if _secret.search(var):
+        return '********'
+    if isinstance(value, dict):
+        return {key: _redact(text_type(key), item)
+                for key, item in value.items()}
+    if type(value) in (list, tuple, set, frozenset):
+        return type(value)(_redact('', item) for item in value)
+    if isinstance(value, string_types) and '://' in value:
+        parts = urlparse.urlparse(value)
+        if parts.password:
+            return parts._replace(netloc=parts.netloc.replace(
+                ':' + parts.password + '@', ':********@')).geturl()
+    if isinstance(value, urlparse.ParseResult) and value.password:
+        return value._replace(netloc=value.netloc.replace(
+            ':' + value.password + '@', ':********@'))
+    return value
+
+
+def to_bytes(value):
+    """Cast for bytes, encoding text the same way as `os.environb`"""
+    if isinstance(value, (bytearray, memoryview)):
+        return bytes(value)
+    if not isinstance(value, bytes):
+        value = _encode(value)
+        if not isinstance(value, bytes):
+            raise TypeError('expected str or bytes, got {}'.format(
+                type(value).__name__))
+    return value
+
+
+def from_base64(value):
+    """Cast for base64 encoded bytes, rejecting any other characters"""
+    return _b64decode(to_bytes(value).strip())
+
+
+def from_base64url(value):
+    """Cast for bytes encoded with the URL and filename safe base64"""
+    value = to_bytes(value).strip()
+    # Padding is often left out of URL safe values
+    return _b64decode(value + b'=' * (-len(value) % 4), altchars=b'-_')
+
+
+def _b64decode(value, altchars=None):
+    # Invalid characters are silently dropped unless validated
+    if sys.version_info[0] == 3:
+        return base64.b64decode(value, altchars, validate=True)
+    alphabet = b'A-Za-z0-9' + re.escape(altchars or b'+/')
+    if not re.match(b'^[' + alphabet + b']*={0,2}$', value):
+        raise binascii.Error('Non-base64 digit found')
+    return base64.b64decode(value, altchars)
+
+
+def from_hex(value):
+    """Cast for hexadecimal encoded bytes"""
+    return binascii.unhexlify(to_bytes(value).strip())
+
+
+class Compressed(object):
+    """Cast for compressed values, which are decompressed before casting
+
+    The encoding lists the steps a value went through, separated by ``+``,
+    and is undone from right to left. For example ``'zlib+base64'`` is a
+    value compressed with zlib, then encoded with base64:
+
+    >>> env = Environment({
+    ...     'ROUTES': 'eNqLrlbKS8xNVbJSUEpJTUsszSlR0lFQKskHCWSUlBRY6eunViTmF'
+    ...               'uSk6iXn5yrVxgIAgTUP2w=='})
+    >>> env.json('ROUTES', encoding='zlib+base64')
+    [{'name': 'default', 'to': 'http://example.com'}]
+
+    Compression is one of ``zlib``, ``gzip``, ``bz2``, ``lzma`` and ``zstd``,
+    which needs the ``zstandard`` package. ``bz2`` and ``lzma`` need Python
+    3.5 or newer. Text encoding is one of ``base64``, ``base64url`` and
+    ``hex``.
+
+    Values are decompressed a chunk at a time, and raise
+    `ImproperlyConfigured` once they grow past `max_size`, or if they are
+    truncated. Cast values are cached by the hash of the compressed value, so
+    values which did not change are not decompressed again. Defaults are
+    given decompressed, and only cast.
+
+    Args:
+        cast: The cast for the decompressed value. Values are decoded as
+            UTF-8, unless cast with `to_bytes`.
+        encoding (`str`): The steps the value went through
+    """
+
+    # Largest decompressed size, and the size of chunks passed to
+    # decompressors
+    max_size = 64 * 1024 * 1024
+    _chunk_size = 64 * 1024
+
+    _codecs = ('base64', 'base64url', 'hex')
+    _compressions = ('zlib', 'gzip', 'bz2', 'lzma', 'zstd')
+
+    def __init__(self, cast, encoding):
+        steps = tuple(encoding.split('+'))
+        for step in steps:
+            if step not in self._codecs + self._compressions:
+                msg = "Encoding '{}' is not valid: unknown step '{}'"
+                raise ImproperlyConfigured(msg.format(encoding, step))
+        self.cast = cast
+        self.encoding = encoding
+        self._steps = steps[::-1]
+
+    def __eq__(self, other):
+        return (isinstance(other, Compressed) and
+                self.encoding == other.encoding and
+                _cast_key(self.cast) == _cast_key(other.cast))
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((self.encoding, _cast_key(self.cast)))
+
+    def __repr__(self):
+        return '<Compressed {}>'.format(_cast_name(self))
+
+    def cast_value(self, environment, var, value):
+        """Decompress and cast a value, using the cache if possible"""
+        if not isinstance(value, (bytes, text_type)):
+            # Values from environs holding other types are not encoded
+            return environment._cast(var, value, self.cast)
+
+        try:
+            key = (hashlib.sha256(to_bytes(value)).digest(), self)
+            cached = _decompressed.get(key)
+        except TypeError:
+            # Unhashable custom cast
+            key = cached = None
+        if _observers and key is not None:
+            _notify('cache', 'compressed', cached is not None)
+        if cached is not None:
+            return _copy_mutable(cached[0])
+
+        data = self.decompress(var, value)
+        if self.cast is not to_bytes:
+            try:
+                data = data.decode('utf-8')
+            except UnicodeDecodeError as e:
+                msg = ("Environment variable '{}' could not be decoded as "
+                       "{}: {}")
+                raise ImproperlyConfigured(msg.format(var, self.encoding, e))
+        value = environment._cast(var, data, self.cast)
+
+        if key is not None:
+            if len(_decompressed) >= _decompressed_size:
+                _decompressed.clear()
+            _decompressed[key] = (value,)
+        return _copy_mutable(value)
+
+    def decompress(self, var, value):
+        """Undo every step of the encoding
+
+        Returns:
+            `bytes`
+
+        Raises:
+            ImproperlyConfigured
+        """
+        data = to_bytes(value)
+        try:
+            for step in self._steps:
+                if step == 'base64':
+                    data = from_base64(data)
+                elif step == 'base64url':
+                    data = from_base64url(data)
+                elif step == 'hex':
+                    data = from_hex(data)
+                else:
+                    data = self._decompress(var, step, data)
+        except ImproperlyConfigured:
+            raise
+        except Exception as e:
+            msg = "Environment variable '{}' could not be decoded as {}: {}"
+            raise ImproperlyConfigured(msg.format(var, self.encoding, e))
+        return data
+
+    def _decompress(self, var, step, data):
+        chunks = []
+        size = 0
+        for chunk in self._chunks(var, step, data):
+            size += len(chunk)
+            if size > self.max_size:
+                msg = ("Environment variable '{}' could not be decoded as "
+                       "{}: larger than {} bytes when decompressed")
+                raise ImproperlyConfigured(
+                    msg.format(var, self.encoding, self.max_size))
+            chunks.append(chunk)
+        return b''.join(chunks)
+
+    def _chunks(self, var, step, data):
+        # Decompressed data, at most a chunk at a time, so that a small value
+        # cannot expand far past max_size before it is rejected
+        limit = self._chunk_size
+        if step == 'zstd':
+            reader = self._module(var, step).ZstdDecompressor().stream_reader(
+                io.BytesIO(data))
+            chunk = reader.read(limit)
+            while chunk:
+                yield chunk
+                chunk = reader.read(limit)
+            return
+
+        if step in ('zlib', 'gzip'):
+            wbits = zlib.MAX_WBITS + (16 if step == 'gzip' else 0)
+            decompressor = zlib.decompressobj(wbits)
+            chunk = decompressor.decompress(data, limit)
+            yield chunk
+            while (not getattr(decompressor, 'eof', False) and
+                   (chunk or decompressor.unconsumed_tail)):
+                chunk = decompressor.decompress(decompressor.unconsumed_tail,
+                                                limit)
+                yield chunk
+            if not hasattr(decompressor, 'eof'):
+                # Before Python 3.3, the end of the stream is not known, so
+                # truncated values cannot be detected
+                return
+        else:
+            if sys.version_info < (3, 5):
+                # Decompressing at most a chunk at a time needs max_length
+                msg = ("Environment variable '{}' could not be decoded as "
+                       "{}: {} needs Python 3.5 or newer")
+                raise ImproperlyConfigured(msg.format(var, self.encoding,
+                                                      step))
+            module = self._module(var, step)
+            if step == 'bz2':
+                decompressor = module.BZ2Decompressor()
+            else:
+                decompressor = module.LZMADecompressor()
+            yield decompressor.decompress(data, limit)
+            while not decompressor.eof and not decompressor.needs_input:
+                yield decompressor.decompress(b'', limit)
+
+        if not decompressor.eof:
+            raise ValueError('the value is truncated')
+
+    def _module(self, var, step):
+        name = 'zstandard' if step == 'zstd' else step
+        try:
+            return _import(name)
+        except ImportError:
+            msg = ("Environment variable '{}' could not be decoded as {}: "
+                   "{} is not available")
+            raise ImproperlyConfigured(msg.format(var, self.encoding, name))
+
+
+def _import(*names):
+    # Import the first of the modules that is available. Modules which are
+    # slow to import, and only needed by some features, are imported when
+    # first used rather than with envy.
+    for name in names[:-1]:
+        try:
+            return importlib.import_module(name)
+        except ImportError:
+            pass
+    return importlib.import_module(names[-1])
+
+
+def _encode(value):
+    # Encode text like the keys and values of os.environb
+    if not isinstance(value, text_type):
+        return value
+    if sys.version_info[0] == 3:
+        return os.fsencode(value)
+    return value.encode(sys.getfilesystemencoding() or 'utf-8')
+
+
+def _encode_raw(var, value):
+    # Encode a variable, or its name, read as text for a binary cast
+    try:
+        return _encode(value)
+    except UnicodeEncodeError as e:
+        msg = ("Environment variable '{}' could not be encoded as bytes: "
+               "{}")
+        raise ImproperlyConfigured(msg.format(var, e))
+
+
+def _view(value, view):
+    # Wrap bytes in a memoryview, without copying them
+    if view and isinstance(value, bytes):
+        return memoryview(value)
+    return value
+
+
+def _cast_key(cast):
+    # Hashable key for a cast, which may be a collection of casts
+    if isinstance(cast, dict):
+        return (dict,) + tuple(_cast_key(c) for c in list(cast.items())[0])
+    if isinstance(cast, (list, set, tuple)):
+        return (type(cast),) + tuple(_cast_key(c) for c in cast)
+    return cast
+
+
+def _is_immutable(value):
+    # Whether a value, and everything in it, cannot be changed in place
+    if isinstance(value, (tuple, frozenset)):
+        return all(_is_immutable(item) for item in value)
+    return value is None or isinstance(
+        value, (text_type, bytes, bool, int, long, float, Decimal))
+
+
+def _copy_mutable(value):
+    # Copy collections handed out from caches, so that callers changing them
+    # do not change the cached value
+    kind = type(value)
+    if kind is dict:
+        items = value.values()
+    elif kind is list or kind is set:
+        items = value
+    else:
+        return value
+    if any(type(item) in (dict, list, set) for item in items):
+        return copy.deepcopy(value)
+    return kind(value)
+
+
+def _is_stable(cast):
+    # Whether a cast is the only one with its name, so that it can be
+    # recognised by name in other processes. Lambdas, functions defined in
+    # other functions and instances are not.
+    if cast is None:
+        return True
+    if isinstance(cast, dict):
+        return all(_is_stable(c) for c in list(cast.items())[0])
+    if isinstance(cast, (list, set, tuple)):
+        return all(_is_stable(c) for c in cast)
+    if isinstance(cast, Compressed):
+        return _is_stable(cast.cast)
+    name = getattr(cast, '__qualname__', getattr(cast, '__name__', None))
+    target = sys.modules.get(getattr(cast, '__module__', None) or '')
+    if name is None or target is None:
+        return False
+    for part in name.split('.'):
+        target = getattr(target, part, None)
+    return target is cast
+
+
+def _cast_name(cast):
+    # Human readable name of a cast, used in reports
+    if cast is None:
+        return 'raw'
+    if isinstance(cast, dict):
+        return 'dict[{}]'.format(', '.join(_cast_name(c)
+                                           for c in list(cast.items())[0]))
+    if isinstance(cast, (list, set, tuple)):
+        return '{}[{}]'.format(type(cast).__name__,
+                               ', '.join(_cast_name(c) for c in cast))
+    if isinstance(cast, Compressed):
+        return '{}[{}]'.format(cast.encoding, _cast_name(cast.cast))
+    if cast is text_type:
+        return 'str'
+    name = getattr(cast, '__name__', None)
+    if name is None:
+        return repr(cast)
+    module = getattr(cast, '__module__', None)
+    if isinstance(cast, type) or module in (None, 'builtins', '__builtin__'):
+        return name
+    return '{}.{}'.format(module, name)
+
+
+def _call_site():
+    # Location of the first frame outside of this module
+    frame = sys._getframe(1)
+    while frame is not None and frame.f_globals.get('__name__') == __name__:
+        frame = frame.f_back
+    if frame is None:
+        return '?'
+    return '{}:{}'.format(frame.f_code.co_filename, frame.f_lineno)
+
+
+def _profile_from_environ(setting):
+    # Enable profiling for the whole process through ENVY_PROFILE, printing a
+    # table to stderr, or writing a Chrome trace if a file name is given.
+    # Invalid settings must not break importing settings.
+    if setting.lower() in ('', '0', 'false', 'no'):
+        return None
+    table = setting.lower() in ('1', 'true', 'table')
+    if not table and not os.path.isdir(os.path.dirname(
+            os.path.abspath(setting))):
+        warnings.warn("ENVY_PROFILE must be 'true', 'table', 'false' or the "
+                      "file name of a Chrome trace, not {!r}".format(setting))
+        return None
+    report = profile()
+    report.start()
+
+    def finish():
+        report.stop()
+        if table:
+            report.print_table(file=sys.stderr)
+        else:
+            with open(setting, 'w') as fp:
+                report.dump_chrome_trace(fp)
+
+    atexit.register(finish)
+    return report
+
+
+def _debug_log_from_environ(setting):
+    # Enable debug logging for the whole process through ENVY_DEBUG_LOG,
+    # set to true or to the fraction of lookups to log. Invalid settings
+    # must not break importing settings.
+    if setting.lower() == 'true':
+        sample = 1.0
+    else:
+        try:
+            sample = float(setting)
+        except ValueError:
+            warnings.warn("ENVY_DEBUG_LOG must be 'true' or a fraction of "
+                          "lookups to log, not {!r}".format(setting))
+            return None
+    return log_lookups(sample)
+
+
+if os.environ.get('ENVY_PROFILE') and __name__ != '__main__':
+    _profile_from_environ(os.environ['ENVY_PROFILE'])
+
+if os.environ.get('ENVY_DEBUG_LOG') and __name__ != '__main__':
+    _debug_log_from_environ(os.environ['ENVY_DEBUG_LOG'])
+
+
+# Export an initialized environment for convenience
+
+env = Environment(os.environ)
+
+
+if __name__ == '__main__':
+    # Run from the importable module, so that state is shared with any
+    # settings importing envy
+    from envy import main as _main
+    sys.exit(_main())
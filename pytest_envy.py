@@ -0,0 +1,183 @@
+"""pytest plugin for isolating environment variables between tests
+
+Installed along with django-envy, and enabled automatically. Provides:
+
+* The ``env`` marker, overriding variables in `envy.env` for a test::
+
+    @pytest.mark.env(DEBUG='true', SECRET_KEY=None)
+    def test_debug():
+        ...
+
+* The ``envy_env`` fixture, an `EnvOverlay` for setting variables in
+  `envy.env` from within a test.
+* The ``envy_environ`` fixture, an `EnvironPatch` for code which reads
+  `os.environ` directly.
+* The ``envy_snapshot`` fixture, an `envy.Environment` over a copy of
+  `os.environ` taken once per process, or once per worker under
+  pytest-xdist.
+
+Overrides from the marker and ``envy_env`` are layered on top of the environ
+with `envy.Environment.override`, so `os.environ` is never copied or
+changed, and nothing needs restoring afterwards. ``envy_environ`` does change
+`os.environ`, but only remembers and restores the variables it changed.
+"""
+from __future__ import unicode_literals
+
+import os
+
+import pytest
+
+import envy
+
+
+class EnvOverlay(object):
+    """Overrides of environment variables for a single test
+
+    Changes are layered on top of the environment with
+    `envy.Environment.override`, and only apply to the current thread or
+    asyncio task. They are discarded when the test ends.
+
+    Args:
+        environment (`envy.Environment`): The environment to override
+    """
+
+    def __init__(self, environment):
+        self.environment = environment
+        self.values = {}
+        self._override = None
+
+    def __getitem__(self, var):
+        return self.environment._raw(var)
+
+    def __setitem__(self, var, value):
+        self.set(var, value)
+
+    def __delitem__(self, var):
+        self.delete(var)
+
+    def __contains__(self, var):
+        return var in self.environment
+
+    def set(self, var, value):
+        """Override a variable, or make it appear unset if `value` is None"""
+        self.update({var: value})
+
+    def delete(self, var):
+        """Make a variable appear unset"""
+        self.update({var: None})
+
+    def update(self, *args, **values):
+        """Override several variables"""
+        self.values.update(*args, **values)
+        self._apply()
+
+    def undo(self):
+        """Remove all overrides"""
+        if self._override is not None:
+            self._override.__exit__(None, None, None)
+            self._override = None
+
+    def _apply(self):
+        self.undo()
+        self._override = self.environment.override(self.values)
+        self._override.__enter__()
+
+
+class EnvironPatch(object):
+    """Changes to a mapping, such as `os.environ`, which can be undone
+
+    Only the variables which are changed are remembered, so undoing the
+    changes takes time proportional to the number of variables changed, not
+    the size of the environment.
+
+    Args:
+        environ (`dict`): The mapping to change, defaults to `os.environ`
+    """
+
+    def __init__(self, environ=None):
+        self.environ = os.environ if environ is None else environ
+        self._saved = {}
+
+    def __getitem__(self, var):
+        return self.environ[var]
+
+    def __setitem__(self, var, value):
+        self.set(var, value)
+
+    def __delitem__(self, var):
+        self.delete(var)
+
+    def __contains__(self, var):
+        return var in self.environ
+
+    def set(self, var, value):
+        """Set a variable, or delete it if `value` is None"""
+        self._save(var)
+        if value is None:
+            self.environ.pop(var, None)
+        else:
+            self.environ[var] = value
+
+    def delete(self, var):
+        """Delete a variable, if it is set"""
+        self.set(var, None)
+
+    def update(self, *args, **values):
+        """Set several variables"""
+        for var, value in dict(*args, **values).items():
+            self.set(var, value)
+
+    def undo(self):
+        """Restore every changed variable to its original value"""
+        for var, value in self._saved.items():
+            if value is envy.NOTSET:
+                self.environ.pop(var, None)
+            else:
+                self.environ[var] = value
+        self._saved = {}
+
+    def _save(self, var):
+        if var not in self._saved:
+            self._saved[var] = self.environ.get(var, envy.NOTSET)
+
+
+def pytest_configure(config):
+    config.addinivalue_line(
+        'markers',
+        'env(**values): override environment variables read through '
+        'envy.env for this test. Use None to unset a variable.')
+
+
+@pytest.fixture(scope='session')
+def envy_snapshot():
+    """Environment over a copy of os.environ, taken once per worker"""
+    return envy.Environment(dict(os.environ))
+
+
+@pytest.fixture
+def envy_env():
+    """Override variables in envy.env for the current test"""
+    overlay = EnvOverlay(envy.env)
+    yield overlay
+    overlay.undo()
+
+
+@pytest.fixture
+def envy_environ():
+    """Change os.environ for the current test"""
+    patch = EnvironPatch()
+    yield patch
+    patch.undo()
+    envy.env.reload()
+
+
+@pytest.fixture(autouse=True)
+def _envy_marker(request):
+    values = {}
+    for marker in reversed(list(request.node.iter_markers('env'))):
+        values.update(*marker.args, **marker.kwargs)
+    if not values:
+        yield
+        return
+    with envy.env.override(values):
+        yield
@@ -33,8 +33,12 @@ setup(
     author_email="mp@miped.dk",
     url="https://github.com/miped/django-envy/",
     license="MIT",
-    py_modules=["envy"],
+    py_modules=["envy", "pytest_envy"],
     tests_require=['pytest'],
+    entry_points={
+        'console_scripts': ['envy = envy:main'],
+        'pytest11': ['envy = pytest_envy'],
+    },
     cmdclass={
         'test': PyTest
     },
@@ -56,6 +60,7 @@ setup(
         "Framework :: Django :: 1.8",
         "Framework :: Django :: 1.9",
         "Framework :: Django :: 1.10",
-        "Framework :: Django :: 1.11"
+        "Framework :: Django :: 1.11",
+        "Framework :: Pytest"
     ],
 )
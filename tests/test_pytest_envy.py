@@ -0,0 +1,88 @@
+# coding: utf-8
+from unittest import TestCase
+
+import pytest
+
+from envy import Environment
+from pytest_envy import EnvOverlay, EnvironPatch
+
+pytest_plugins = ['pytester']
+
+
+class TestEnvOverlay(TestCase):
+
+    def test_set_and_delete(self):
+        e = Environment({'FOO': '0', 'BAR': '1'})
+        overlay = EnvOverlay(e)
+        overlay['FOO'] = '1'
+        del overlay['BAR']
+        self.assertEqual(e('FOO'), '1')
+        self.assertFalse('BAR' in e)
+        self.assertEqual(overlay['FOO'], '1')
+        overlay.undo()
+        self.assertEqual(e('FOO'), '0')
+        self.assertEqual(e('BAR'), '1')
+
+    def test_does_not_change_environ(self):
+        environ = {'FOO': '0'}
+        overlay = EnvOverlay(Environment(environ))
+        overlay.update(FOO='1', BAR='2')
+        self.assertEqual(environ, {'FOO': '0'})
+        overlay.undo()
+
+
+class TestEnvironPatch(TestCase):
+
+    def test_undo_restores_changed_variables(self):
+        environ = {'FOO': '0', 'BAR': '1', 'BAZ': '2'}
+        patch = EnvironPatch(environ)
+        patch['FOO'] = '1'
+        patch['FOO'] = '2'
+        del patch['BAR']
+        patch.update(NEW='3')
+        self.assertEqual(environ, {'FOO': '2', 'BAZ': '2', 'NEW': '3'})
+        patch.undo()
+        self.assertEqual(environ, {'FOO': '0', 'BAR': '1', 'BAZ': '2'})
+
+    def test_only_remembers_changed_variables(self):
+        patch = EnvironPatch({'FOO': '0', 'BAR': '1'})
+        patch['FOO'] = '1'
+        self.assertEqual(patch._saved, {'FOO': '0'})
+
+
+@pytest.fixture
+def plugin_tester(request):
+    # The pytester fixture needs pytest 6.2, older versions have testdir
+    name = 'pytester' if hasattr(pytest, 'Pytester') else 'testdir'
+    return request.getfixturevalue(name)
+
+
+def test_plugin(plugin_tester):
+    plugin_tester.makepyfile('''
+        import os
+        import pytest
+        from envy import env
+
+        @pytest.mark.env(ENVY_PLUGIN_A='1', ENVY_PLUGIN_B=None)
+        def test_marker():
+            assert env.int('ENVY_PLUGIN_A') == 1
+            assert 'ENVY_PLUGIN_B' not in env
+            assert 'ENVY_PLUGIN_A' not in os.environ
+
+        def test_marker_removed():
+            assert 'ENVY_PLUGIN_A' not in env
+
+        def test_envy_env(envy_env):
+            envy_env['ENVY_PLUGIN_A'] = '2'
+            assert env('ENVY_PLUGIN_A') == '2'
+
+        def test_envy_environ(envy_environ):
+            envy_environ['ENVY_PLUGIN_A'] = '3'
+            assert os.environ['ENVY_PLUGIN_A'] == '3'
+
+        def test_restored(envy_snapshot):
+            assert 'ENVY_PLUGIN_A' not in os.environ
+            assert 'ENVY_PLUGIN_A' not in envy_snapshot
+    ''')
+    result = plugin_tester.runpytest('-p', 'pytest_envy')
+    result.assert_outcomes(passed=5)